@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""collectParams.py: collect the expectations of an EM iteration into parameters
+
+Does in one process what the M step used to do with two collectParameters
+runs: sums the expectations of every *learned_parameters.fa file of an
+iteration, factor by factor, turns each row of a factor (target_dim
+values, total_dim / target_dim rows, as given in its header or by the
+target indices of older files) into probabilities, and writes the
+parameter file for the next iteration.
+
+Masks (mask.expectations, mask.params of a dogma) hold a block for each
+factor they apply to, under the factor's header with "mask " after the
+">".  A nan leaves the value as it is; in the expectation mask a value of
+0 or more replaces the summed expectation and a negative value -k ties it
+to entry k (from 0) of the factor, every entry tied to k getting the sum
+of the group; in the parameter mask a value replaces the parameter.
+
+The parameter file has the header "> parameters em_iters=<n> logZ=<z>",
+with the logZ summed over the expectation files, and is written in the
+style of its inputs: one value per line, or "target source value" lines.
+
+Usage:
+  collectParams.py [options] paramsFile expectationFile [...]
+
+Options:
+  -e file   mask of the summed expectations
+  -m file   mask of the parameters
+  -q        run quietly
+"""
+import os, sys, getopt, re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+verbose = True
+
+## added to every summed expectation
+pseudoCount = 0.0
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def headerValue(header, key, default = None):
+    m = re.search("%s=([0-9.e+-]+)" % key, header)
+    if m is None:
+        return default
+    return float(m.group(1))
+
+def factorDims(header, lines):
+    """
+    (target_dim, total_dim) of a factor, from its header or, for the
+    older "target source value" lines, from the target indices
+    """
+    targetDim = headerValue(header, "target_dim")
+    totalDim = headerValue(header, "total_dim")
+    if targetDim is not None and totalDim is not None:
+        return (int(targetDim), int(totalDim))
+    if len(lines) > 0 and len(lines[0].split()) > 1:
+        return (max([int(line.split()[0]) for line in lines]) + 1, len(lines))
+    raise ValueError("no target_dim and total_dim in %s" % header)
+
+def parseValues(lines, fields):
+    """the values of the lines of a block, the last of fields per line"""
+    if numpy is not None:
+        values = numpy.fromstring(" ".join(lines), sep = " ")
+        if fields > 1:
+            values = values.reshape((-1, fields))[:, -1]
+        return values
+    return [float(line.split()[-1]) for line in lines]
+
+def readBlocks(filename):
+    """
+    The header line of a parameter style file, the number of fields of
+    its value lines, and its (factor header, values, dims) blocks in file
+    order, dims as given by factorDims
+    """
+    f = open(filename, "r")
+    header = f.readline().rstrip("\r\n")
+    lines = [line for line in f.read().splitlines() if line and not line.isspace()]
+    f.close()
+    blocks = []
+    fields = 1
+    starts = [i for i, line in enumerate(lines) if line.startswith(">")]
+    for n, start in enumerate(starts):
+        if n + 1 < len(starts):
+            end = starts[n + 1]
+        else:
+            end = len(lines)
+        if end > start + 1:
+            fields = len(lines[start + 1].split())
+        block = lines[start + 1:end]
+        if lines[start].startswith("> mask"):
+            dims = None
+        else:
+            dims = factorDims(lines[start], block)
+        blocks.append((lines[start], parseValues(block, fields), dims))
+    return (header, fields, blocks)
+
+def readMask(filename):
+    """factor header to mask values"""
+    mask = {}
+    (header, fields, blocks) = readBlocks(filename)
+    for (factor, values, dims) in blocks:
+        mask[re.sub("^>\s*mask\s+", "> ", factor)] = values
+    return mask
+
+class Collector:
+    """sums of the expectations of each factor over expectation files"""
+    def __init__(self):
+        self.factors = []
+        self.dims = {}
+        self.sums = {}
+        self.logZ = 0.0
+        self.emIters = 0
+        self.fields = 1
+        self.files = 0
+    def add(self, filename):
+        (header, fields, blocks) = readBlocks(filename)
+        self.logZ += headerValue(header, "logZ", 0.0)
+        self.emIters = max(self.emIters, int(headerValue(header, "em_iters", 0)))
+        self.fields = fields
+        self.files += 1
+        for (factor, values, dims) in blocks:
+            if factor not in self.dims:
+                self.dims[factor] = dims
+                self.factors.append(factor)
+                self.sums[factor] = None
+            if len(values) != self.dims[factor][1]:
+                raise ValueError("%s: %i values for total_dim=%i in %s"
+                                 % (filename, len(values), self.dims[factor][1], factor))
+            if self.sums[factor] is None:
+                if numpy is not None:
+                    self.sums[factor] = numpy.array(values, dtype = numpy.float64)
+                else:
+                    self.sums[factor] = list(values)
+            elif numpy is not None:
+                self.sums[factor] += values
+            else:
+                self.sums[factor] = [s + v for s, v in zip(self.sums[factor], values)]
+    def parameters(self, factor, expectationMask = {}, paramMask = {}):
+        """the parameters of a factor, rows normalized to probabilities"""
+        (targetDim, totalDim) = self.dims[factor]
+        values = [v + pseudoCount for v in self.sums[factor]]
+        if factor in expectationMask:
+            values = maskExpectations(values, expectationMask[factor])
+        if numpy is not None:
+            rows = numpy.array(values, dtype = numpy.float64).reshape((-1, targetDim))
+            totals = rows.sum(axis = 1)
+            rows[totals == 0] = 1.0
+            totals[totals == 0] = targetDim
+            params = (rows / totals[:, numpy.newaxis]).ravel().tolist()
+        else:
+            params = []
+            for r in range(0, totalDim, targetDim):
+                row = values[r:r + targetDim]
+                total = sum(row)
+                if total == 0:
+                    params += [1.0 / targetDim] * targetDim
+                else:
+                    params += [v / total for v in row]
+        if factor in paramMask:
+            params = [p if m != m else m for p, m in zip(params, paramMask[factor])]
+        return params
+    def write(self, filename, expectationMask = {}, paramMask = {}):
+        f = open(filename, "w")
+        f.write("> parameters em_iters=%i logZ=%.12g\n" % (self.emIters, self.logZ))
+        for factor in self.factors:
+            targetDim = self.dims[factor][0]
+            f.write("%s\n" % factor)
+            params = self.parameters(factor, expectationMask, paramMask)
+            if self.fields > 1:
+                f.write("".join(["%s\t%s\t%4f\n" % (k % targetDim, k / targetDim, p)
+                                 for k, p in enumerate(params)]))
+            else:
+                f.write("".join(["%g\n" % p for p in params]))
+        f.close()
+
+def maskExpectations(values, mask):
+    """applies an expectation mask, see the module documentation"""
+    values = [float(v) for v in values]
+    groups = {}
+    for k, m in enumerate(mask):
+        if m == m and m < 0:
+            groups.setdefault(int(-m), []).append(k)
+    for members in groups.values():
+        total = sum([values[k] for k in members])
+        for k in members:
+            values[k] = total
+    for k, m in enumerate(mask):
+        if m == m and m >= 0:
+            values[k] = m
+    return values
+
+def collectParameters(paramsFile, expectationFiles, expectationMaskFile = None,
+                      paramMaskFile = None):
+    """writes the parameters collected from expectation files to paramsFile"""
+    if len(expectationFiles) == 0:
+        raise ValueError("no expectation files for %s" % paramsFile)
+    collector = Collector()
+    for filename in expectationFiles:
+        collector.add(filename)
+    expectationMask = {}
+    if expectationMaskFile is not None:
+        expectationMask = readMask(expectationMaskFile)
+    paramMask = {}
+    if paramMaskFile is not None:
+        paramMask = readMask(paramMaskFile)
+    collector.write(paramsFile, expectationMask, paramMask)
+    log("collected %i factors of %i files into %s\n"
+        % (len(collector.factors), collector.files, paramsFile))
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "e:m:q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) < 2:
+        print "incorrect number of arguments"
+        usage(1)
+    expectationMaskFile = None
+    paramMaskFile = None
+    global verbose
+    for o, a in opts:
+        if o == "-e":
+            expectationMaskFile = a
+        elif o == "-m":
+            paramMaskFile = a
+        elif o == "-q":
+            verbose = False
+    collectParameters(args[0], args[1:], expectationMaskFile, paramMaskFile)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""costModel.py: runtime model of paradigm jobs
+
+Predicts the wall time of a paradigm job from the number of samples it
+runs, the number of evidence files and the size (nodes and edges) of its
+pathway.  The time per sample is fit as
+
+  log(seconds / samples) = w0 + w1 log(nodes+1) + w2 log(edges+1) + w3 log(evidence)
+
+over every observed job, plus a per-pathway correction: the mean residual
+of that pathway's jobs, shrunk towards 0 by how much of it is timing
+noise rather than a real difference between pathways.
+
+Observations come from the timings.tab of a pathway directory (see
+timePathways.py to measure one) and from a runtime history file, which
+grows with the jobs of finished runs: prepareParadigm.py writes
+jobFeatures.tab, jtParadigm.py and localParadigm.py append each job's wall
+time to jobTimes.tab, and recordRun() joins the two into the history.
+
+Usage:
+  costModel.py [options] history
+
+Options:
+  -r dir    add the jobs of the run in dir to history first
+  -p dir    also use the timings.tab of pathway directory dir
+  -q        run quietly
+"""
+import os, sys, getopt, re, math
+
+verbose = True
+
+featuresFile = "jobFeatures.tab"
+timesFile = "jobTimes.tab"
+statsFile = "pathwayStats.tab"
+historyHeader = "# seconds\tsamples\tevidence\tnodes\tedges\tpathway\n"
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def pathwayStats(filename):
+    """number of nodes and edges of a pathway file"""
+    nodes = 0
+    edges = 0
+    f = open(filename, "r")
+    for line in f:
+        pline = line.rstrip("\r\n").split("\t")
+        if len(pline) == 2:
+            nodes += 1
+        elif len(pline) >= 3:
+            edges += 1
+    f.close()
+    return (nodes, edges)
+
+def writePathwayStats(filename, stats):
+    """writes a pathway name to (nodes, edges) map"""
+    f = open(filename, "w")
+    f.write("# pathway\tnodes\tedges\n")
+    for pathway in sorted(stats.keys()):
+        f.write("%s\t%i\t%i\n" % ((pathway,) + stats[pathway]))
+    f.close()
+
+def readPathwayStats(directory):
+    """the pathwayStats.tab of a pathway directory, empty if there is none"""
+    stats = {}
+    statsPath = os.path.join(directory, statsFile)
+    if not os.path.exists(statsPath):
+        return stats
+    f = open(statsPath, "r")
+    for line in f:
+        if line.startswith("#") or line.isspace():
+            continue
+        pline = line.rstrip("\r\n").split("\t")
+        stats[pline[0]] = (int(pline[1]), int(pline[2]))
+    f.close()
+    return stats
+
+def readTimings(directory, evidence, stats):
+    """
+    Observations from the timings.tab of a pathway directory, taken to
+    have been run with the given number of evidence files; pathways
+    missing from stats (a pathway name to (nodes, edges) map) are skipped
+    """
+    observations = []
+    timingFile = os.path.join(directory, "timings.tab")
+    if not os.path.exists(timingFile):
+        return observations
+    tfile = open(timingFile, "r")
+    m = re.search('^#\s*samples\s*(\d+)\s*', tfile.readline().rstrip())
+    if not m:
+        log("missing samples line in %s\n" % (timingFile))
+        tfile.close()
+        return observations
+    samples = int(m.group(1))
+    for line in tfile:
+        if line.isspace():
+            continue
+        timestring, pathway = line.rstrip().split("\t")
+        if pathway not in stats:
+            continue
+        (nodes, edges) = stats[pathway]
+        observations.append((float(timestring), samples, evidence, nodes, edges, pathway))
+    tfile.close()
+    return observations
+
+def readHistory(filename):
+    """observations of a runtime history file"""
+    observations = []
+    if not os.path.exists(filename):
+        return observations
+    f = open(filename, "r")
+    for line in f:
+        if line.startswith("#") or line.isspace():
+            continue
+        pline = line.rstrip("\r\n").split("\t")
+        observations.append((float(pline[0]), int(pline[1]), int(pline[2]),
+                             int(pline[3]), int(pline[4]), pline[5]))
+    f.close()
+    return observations
+
+def appendHistory(filename, observations):
+    writeHeader = not os.path.exists(filename)
+    f = open(filename, "a")
+    if writeHeader:
+        f.write(historyHeader)
+    for obs in observations:
+        f.write("%.2f\t%i\t%i\t%i\t%i\t%s\n" % obs)
+    f.close()
+
+def recordRun(runDir, historyFile):
+    """
+    Adds the timed jobs of a run to the history; the job times are moved
+    aside so that a run is only recorded once.  Returns the number added.
+    """
+    featurePath = os.path.join(runDir, featuresFile)
+    timePath = os.path.join(runDir, timesFile)
+    if not os.path.exists(featurePath) or not os.path.exists(timePath):
+        return 0
+    features = {}
+    f = open(featurePath, "r")
+    for line in f:
+        if line.startswith("#"):
+            continue
+        pline = line.rstrip("\r\n").split("\t")
+        features[pline[0]] = (int(pline[2]), int(pline[3]), int(pline[4]),
+                              int(pline[5]), pline[1])
+    f.close()
+    observations = []
+    f = open(timePath, "r")
+    for line in f:
+        pline = line.rstrip("\r\n").split("\t")
+        if len(pline) != 2 or pline[0] not in features:
+            continue
+        (samples, evidence, nodes, edges, pathway) = features[pline[0]]
+        if samples == 0:
+            continue
+        observations.append((float(pline[1]), samples, evidence, nodes, edges, pathway))
+    f.close()
+    appendHistory(historyFile, observations)
+    os.rename(timePath, timePath + ".recorded")
+    return len(observations)
+
+def solve(a, b):
+    """solves a x = b by gaussian elimination with partial pivoting"""
+    n = len(b)
+    a = [row[:] + [v] for row, v in zip(a, b)]
+    for i in range(n):
+        p = max(range(i, n), key = lambda r: abs(a[r][i]))
+        a[i], a[p] = a[p], a[i]
+        for r in range(i + 1, n):
+            factor = a[r][i] / a[i][i]
+            for c in range(i, n + 1):
+                a[r][c] -= factor * a[i][c]
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (a[i][n] - sum([a[i][c] * x[c] for c in range(i + 1, n)])) / a[i][i]
+    return x
+
+class CostModel:
+    """
+    Fit of the seconds per sample of a job, see the module documentation;
+    ridge keeps the fit defined when a feature does not vary (such as the
+    evidence count of a single run) and noiseVariance is the variance of
+    log job times of one pathway, used until pathways with more than one
+    observed job give an estimate of it
+    """
+    def __init__(self, observations = [], ridge = 1e-6, noiseVariance = 0.01):
+        self.ridge = ridge
+        self.noiseVariance = noiseVariance
+        self.weights = None
+        self.correction = {}
+        self.count = 0
+        if len(observations) > 0:
+            self.fit(observations)
+    def features(self, evidence, nodes, edges):
+        return [1.0, math.log(nodes + 1), math.log(edges + 1), math.log(max(1, evidence))]
+    def fit(self, observations):
+        observations = [o for o in observations if o[1] > 0]
+        self.count = len(observations)
+        if self.count == 0:
+            self.weights = None
+            self.correction = {}
+            return
+        xs = [self.features(o[2], o[3], o[4]) for o in observations]
+        ## times are recorded to the hundredth of a second
+        ys = [math.log(max(o[0], 0.01) / o[1]) for o in observations]
+        k = len(xs[0])
+        xtx = [[sum([x[i] * x[j] for x in xs]) for j in range(k)] for i in range(k)]
+        xty = [sum([x[i] * y for x, y in zip(xs, ys)]) for i in range(k)]
+        ## the intercept is not penalized
+        for i in range(1, k):
+            xtx[i][i] += self.ridge * self.count
+        self.weights = solve(xtx, xty)
+        residuals = {}
+        for o, x, y in zip(observations, xs, ys):
+            r = y - sum([w * v for w, v in zip(self.weights, x)])
+            residuals.setdefault(o[5], []).append(r)
+        ## within-pathway (noise) and between-pathway variance of residuals
+        within = 0.0
+        withinCount = 0
+        between = 0.0
+        for rs in residuals.values():
+            m = sum(rs) / len(rs)
+            within += sum([(r - m)**2 for r in rs])
+            withinCount += len(rs) - 1
+            between += m**2
+        if withinCount > 0:
+            noise = within / withinCount
+        else:
+            noise = self.noiseVariance
+        between = max(between / len(residuals), 1e-12)
+        self.correction = {}
+        for pathway, rs in residuals.items():
+            shrink = len(rs) * between / (len(rs) * between + noise)
+            self.correction[pathway] = shrink * sum(rs) / len(rs)
+    def perSample(self, pathway, evidence, nodes, edges):
+        """predicted seconds per sample"""
+        x = self.features(evidence, nodes, edges)
+        logTime = sum([w * v for w, v in zip(self.weights, x)])
+        return math.exp(logTime + self.correction.get(pathway, 0.0))
+    def predict(self, pathway, samples, evidence, nodes, edges):
+        """predicted seconds of a job on the given number of samples"""
+        return samples * self.perSample(pathway, evidence, nodes, edges)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "r:p:q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        print "incorrect number of arguments"
+        usage(1)
+    historyFile = args[0]
+    runDir = None
+    pathwayDir = None
+    global verbose
+    for o, a in opts:
+        if o == "-r":
+            runDir = a
+        elif o == "-p":
+            pathwayDir = a
+        elif o == "-q":
+            verbose = False
+    if runDir is not None:
+        added = recordRun(runDir, historyFile)
+        log("recorded %i jobs of %s in %s\n" % (added, runDir, historyFile))
+    observations = readHistory(historyFile)
+    if pathwayDir is not None:
+        stats = {}
+        for p in os.listdir(pathwayDir):
+            if p.endswith("_pathway.tab"):
+                stats[p] = pathwayStats(os.path.join(pathwayDir, p))
+        ## the evidence count of timings.tab is unknown, take the usual two
+        observations += readTimings(pathwayDir, 2, stats)
+    model = CostModel(observations)
+    if model.weights is None:
+        print "no observations"
+        return
+    print "%i observations, %i pathways" % (model.count, len(model.correction))
+    print "log(seconds/sample) = %.4g + %.4g log(nodes+1) + %.4g log(edges+1) + %.4g log(evidence)" \
+        % tuple(model.weights)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,6 +6,17 @@ import time
 import random
 import array
 import math
+import hashlib
+import json
+import multiprocessing
+
+import matrixCache
+import tabWriter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #from guppy import hpy
 
@@ -19,6 +30,14 @@ batches = 1
 sameSample = False
 trueFileDir = ''
 geneIntersection = True
+seed = None
+processes = 1
+lazySpec = None
+if numpy is not None:
+    engine = "numpy"
+else:
+    engine = "python"
+engines = ["numpy", "python"]
 
 def usage(code=0):
     print "createNullFiles.py: create null data files from tuples of data"
@@ -38,65 +57,166 @@ def usage(code=0):
     print "   -g float   minimum fraction of genes present in all files"
     print "   -t dir     write restricted true files here"
     print "   -u         use union of gene list rather than intersection"
+    print "   -r int     master seed, batch b is drawn with a seed derived from it"
+    print "   -j int     number of batches written concurrently (default 1)"
+    print "   -e str     null engine: numpy (default when available) or python"
+    print "   -l file    don't write the batches, write a null spec to file instead"
+    print "              (needs -t) so jobs can generate their own slice of them"
     print "   -q         don't output logging information"
+    print ""
+    print "Generating a slice of a null batch from a spec written by -l:"
+    print "   createNullFiles.py [-q] -S spec -k batch,k,n -p prefix"
+    print "   writes null samples of bucket k of n of batch (1-based) to"
+    print "   prefix<file> for every file of the spec"
     if code != None:
         sys.exit(code)
 
-class NamedMatrix(dict):
+class NamedMatrix:
+    """
+    A float32 matrix with named rows and columns, held as one contiguous
+    block: a numRows x numCols numpy array, or a flat row-major
+    array.array("f") when numpy is not available.  Rows and columns are
+    found through name to index maps; restricting either one is a single
+    gather of the block, not a rebuild of every row.
+    """
     @classmethod
     def fromFile(cls, filename, sep="\t"):
+        cached = matrixCache.loadCache(filename, sep)
+        if cached is not None:
+            if numpy is not None:
+                values = numpy.asarray(cached.values, dtype=numpy.float32)
+            else:
+                values = cached.getValues()
+            return cls(cached.corner, cached.cols, cached.rows, values)
         fh = open(filename, "r")
         header = fh.readline().rstrip("\r\n").split(sep)
-        self = cls(header[0], header[1:])
+        numCols = len(header) - 1
+        rownames = []
+        values = array.array('f')
         for l in fh:
             vals = l.rstrip("\r\n").split(sep)
-            fvals = array.array('f')
-            for v in vals[1:]:
+            rownames.append(vals[0])
+            for v in vals[1:numCols + 1]:
                 try:
-                    fvals.append(float(v))
+                    values.append(float(v))
                 except ValueError:
-                    fvals.append(float('nan'))
-            self.addSample(vals[0], fvals)
+                    values.append(float('nan'))
+            ## short rows are padded with missing values
+            for i in range(len(vals) - 1, numCols):
+                values.append(float('nan'))
         fh.close()
-        return self
-    def __init__(self, corner, colnames):
+        if numpy is not None:
+            values = numpy.frombuffer(values, dtype=numpy.float32)
+        return cls(header[0], header[1:], rownames, values)
+    def __init__(self, corner, colnames, rownames=None, values=None):
         self._corner = corner
         self.__setColNames(colnames)
+        if rownames is None:
+            rownames = []
+            values = array.array('f')
+        self.__setRowNames(rownames)
+        if numpy is not None:
+            values = numpy.asarray(values, dtype=numpy.float32)
+            values = values.reshape((len(self._rownames), len(self._colnames)))
+        self._values = values
     def __setColNames(self, colnames):
         self._colnames = colnames
         self._nameToCol = dict(zip(self._colnames, range(len(self._colnames))))
+    def __setRowNames(self, rownames):
+        self._rownames = rownames
+        self._nameToRow = dict(zip(self._rownames, range(len(self._rownames))))
+    def keys(self):
+        return list(self._rownames)
+    def __contains__(self, sampleName):
+        return sampleName in self._nameToRow
+    def __getitem__(self, sampleName):
+        """the values of a row, a view of the block under numpy"""
+        i = self._nameToRow[sampleName]
+        if numpy is not None:
+            return self._values[i]
+        numCols = len(self._colnames)
+        return self._values[i*numCols:(i+1)*numCols]
+    def rowIndices(self, rowList):
+        return [self._nameToRow[name] for name in rowList]
+    def flatValues(self):
+        """all values, row-major, as one flat array.array("f")"""
+        if numpy is not None:
+            values = array.array('f')
+            values.fromstring(numpy.ascontiguousarray(self._values).tostring())
+            return values
+        return self._values
     def addSample(self, sampleName, vals):
         # print "adding sample %s with %i vals" % (sampleName, len(vals))
-        self[sampleName] = vals
+        if sampleName in self._nameToRow:
+            i = self._nameToRow[sampleName]
+            if numpy is not None:
+                self._values[i] = vals
+            else:
+                numCols = len(self._colnames)
+                self._values[i*numCols:(i+1)*numCols] = array.array('f', vals)
+            return
+        self._nameToRow[sampleName] = len(self._rownames)
+        self._rownames.append(sampleName)
+        if numpy is not None:
+            row = numpy.asarray(vals, dtype=numpy.float32)
+            self._values = numpy.vstack((self._values, row[numpy.newaxis, :]))
+        else:
+            self._values.extend(array.array('f', vals))
     def restrictColumns(self, columnList):
-        l = len(self._colnames)
-        colOrder = [self._nameToCol.get(name, l) for name in columnList]
-        for row in self.keys():
-            data = self[row]
-            data.append(float("nan"))
-            self[row] = [data[col] for col in colOrder]
+        colOrder = [self._nameToCol.get(name, -1) for name in columnList]
+        if colOrder == range(len(self._colnames)):
+            self.__setColNames(columnList)
+            return
+        missing = [i for i, col in enumerate(colOrder) if col < 0]
+        if numpy is not None:
+            if len(self._colnames) == 0:
+                values = numpy.empty((len(self._rownames), len(colOrder)),
+                                     dtype=numpy.float32)
+            else:
+                values = self._values.take(colOrder, axis=1)
+            values[:, missing] = float("nan")
+        else:
+            numCols = len(self._colnames)
+            old = self._values
+            values = array.array('f')
+            for base in range(0, len(old), max(1, numCols)):
+                values.extend(array.array('f', [old[base + col] if col >= 0
+                                                else float("nan")
+                                                for col in colOrder]))
+        self._values = values
         self.__setColNames(columnList)
+    def restrictRows(self, rowList):
+        rowOrder = self.rowIndices(rowList)
+        if rowOrder == range(len(self._rownames)):
+            self.__setRowNames(rowList)
+            return
+        if numpy is not None:
+            values = self._values.take(rowOrder, axis=0)
+        else:
+            numCols = len(self._colnames)
+            old = self._values
+            values = array.array('f')
+            for i in rowOrder:
+                values.extend(old[i*numCols:(i+1)*numCols])
+        self._values = values
+        self.__setRowNames(list(rowList))
     def describe(self):
-        print "%i rows, %i columns" % (len(self.keys()), len(self._colnames))
-    def writeLineToFile(self, fh, label, vals, sep="\t"):
-        fh.write(label)
-        for v in vals:
-            fh.write(sep)
-            try:
-                if not math.isnan(v):
-                    fh.write(str(v))
-                else:
-                    fh.write("NA")
-            except TypeError:
-                fh.write(str(v))
-        fh.write("\n")
+        print "%i rows, %i columns" % (len(self._rownames), len(self._colnames))
     def writeToFile(self, filename, sep="\t"):
-        fh = open(filename, "w")
-        self.writeLineToFile(fh, self._corner, self._colnames, sep)
-        for row in self.keys():
+        w = tabWriter.TabWriter(filename, sep)
+        w.writeHeader(self._corner, self._colnames)
+        for row in self._rownames:
             # print "writing row %s" % row
-            self.writeLineToFile(fh, row, self[row], sep)
-        fh.close()
+            w.writeRow(row, self[row])
+        w.close()
+
+def stackMatrices(matrices, samples):
+    """matrix x sample x gene block of the given samples of each matrix"""
+    block = numpy.empty((len(matrices), len(samples), len(matrices[0]._colnames)),
+                        dtype=numpy.float32)
+    for m, values in zip(matrices, block):
+        m._values.take(m.rowIndices(samples), axis=0, out=values)
+    return block
 
 def outputFileName(outputPrefix, fn):
     path = outputPrefix + os.path.basename(fn)
@@ -106,6 +226,175 @@ def log(msg):
     if (verbose):
         sys.stderr.write(msg)
 
+def batchSeed(masterSeed, b):
+    """
+    Seed of batch b derived from the master seed, so any batch can be
+    regenerated on its own and in any process
+    """
+    if masterSeed is None:
+        return None
+    digest = hashlib.sha1("%d:%d" % (masterSeed, b)).hexdigest()
+    return int(digest[:8], 16)
+
+def batchNames(b, numSamples, samples):
+    """output prefix and null sample names of batch b"""
+    prefix = outputPrefix
+    numOffset = 1+ numberingOffset + b*numSamples
+    if batches > 1:
+        prefix += "_" + str(b + 1) +  "_"
+    if sameSample:
+        nullSamples = [samplePrefix + "_" + str(b+1) + "_" + samples[i]
+                       for i in range(numSamples)]
+    else:
+        nullSamples = [samplePrefix + str(i + numOffset)
+                       for i in range(numSamples)]
+    return (prefix, nullSamples)
+
+## what the batch writers need; set before any worker process is forked
+nullState = {}
+
+def runBatches(writeBatch):
+    if processes > 1 and batches > 1:
+        pool = multiprocessing.Pool(min(processes, batches))
+        try:
+            pool.map(writeBatch, range(batches))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for b in range(batches):
+            writeBatch(b)
+
+def writeBatchNumpy(b, lo=0, hi=None, prefix=None):
+    """
+    Draws the sample and gene index of every null cell of batch b in bulk
+    and gathers them from all matrices at once with fancy indexing; only
+    null samples lo to hi are written, to prefix<file> if prefix is given
+    """
+    numSamples = nullState["numSamples"]
+    samples = nullState["samples"]
+    genes = nullState["genes"]
+    block = nullState["block"]
+    if hi is None:
+        hi = numSamples
+    print "writing batch %i" % (b+1)
+    rng = numpy.random.RandomState(batchSeed(seed, b))
+    (batchPrefix, nullSamples) = batchNames(b, numSamples, samples)
+    if prefix is None:
+        prefix = batchPrefix
+    if sameSample:
+        randomG = numpy.argsort(rng.random_sample((numSamples, len(genes))), axis=1)
+        randomS = numpy.arange(numSamples)[:, numpy.newaxis]
+    else:
+        randomG = rng.randint(0, len(genes), size=(numSamples, len(genes)))
+        randomS = rng.randint(0, len(samples), size=(numSamples, len(genes)))
+    nulls = block[:, randomS[lo:hi], randomG[lo:hi]]
+    for fn, m, null in zip(nullState["files"], nullState["matrices"], nulls):
+        print "%i rows, %i columns" % (hi - lo, len(genes))
+        tabWriter.writeMatrix(outputFileName(prefix, fn), m._corner, genes,
+                              nullSamples[lo:hi], null)
+
+def writeBatchPython(b, lo=0, hi=None, prefix=None):
+    numSamples = nullState["numSamples"]
+    samples = nullState["samples"]
+    genes = nullState["genes"]
+    matrices = nullState["matrices"]
+    if hi is None:
+        hi = numSamples
+    print "writing batch %i" % (b+1)
+    rng = random.Random(batchSeed(seed, b))
+    ## compact flat values and row offsets, no per-cell row lookups
+    flatM = [m.flatValues() for m in matrices]
+    offsets = [dict(zip(samples, [i * len(genes) for i in m.rowIndices(samples)]))
+               for m in matrices]
+    nullValues = [array.array('f') for m in matrices]
+    (batchPrefix, nullSamples) = batchNames(b, numSamples, samples)
+    if prefix is None:
+        prefix = batchPrefix
+    for i in range(numSamples):
+        geneIndices = range(len(genes))
+        if sameSample:
+            rng.shuffle(geneIndices)
+            randomG = geneIndices
+            randomS = [samples[i] for s in geneIndices]
+        else:
+            randomG = [rng.choice(geneIndices) for gi in geneIndices]
+            randomS = [rng.choice(samples) for s in geneIndices]
+        ## earlier samples are still drawn to keep the generator in step
+        if i < lo or i >= hi:
+            continue
+        for null, values, offset in zip(nullValues, flatM, offsets):
+            #data = [m[s][g] for s, g in zip(randomS, randomG)]
+            for s, g in zip(randomS, randomG):
+                null.append(values[offset[s] + g])
+
+    nullM = [NamedMatrix(m._corner, genes, nullSamples[lo:hi], values)
+             for m, values in zip(matrices, nullValues)]
+    for fn, m in zip(nullState["files"], nullM):
+        m.describe()
+        m.writeToFile(outputFileName(prefix, fn))
+
+def writeNullSpec(specFile, numSamples, files):
+    """
+    Records what a job needs to regenerate any slice of the null batches
+    from the restricted true files
+    """
+    spec = {"seed" : seed,
+            "batches" : batches,
+            "numSamples" : numSamples,
+            "sameSample" : sameSample,
+            "numberingOffset" : numberingOffset,
+            "samplePrefix" : samplePrefix,
+            "engine" : engine,
+            "files" : [os.path.join(trueFileDir, os.path.basename(fn))
+                       for fn in files]}
+    o = open(specFile, "w")
+    json.dump(spec, o, indent=1)
+    o.close()
+
+def createNullSlice(specFile, batch, bucket, buckets):
+    """
+    Writes null samples of bucket k of n of a batch (1-based) as described
+    by a null spec; the samples are the same rows the batch file would
+    have had if the batches had been written up front
+    """
+    global seed, batches, sameSample, numberingOffset, samplePrefix, engine
+    f = open(specFile, "r")
+    spec = json.load(f)
+    f.close()
+    seed = spec["seed"]
+    batches = spec["batches"]
+    sameSample = spec["sameSample"]
+    numberingOffset = spec["numberingOffset"]
+    samplePrefix = spec["samplePrefix"].encode("utf-8")
+    engine = spec["engine"]
+    if engine == "numpy" and numpy is None:
+        print "null spec %s needs the numpy engine but numpy is not installed" % specFile
+        sys.exit(5)
+    if batch < 1 or batch > batches or bucket < 0 or bucket >= buckets:
+        print "no bucket %i of %i in batch %i of %s" % (bucket, buckets, batch, specFile)
+        sys.exit(5)
+    files = [fn.encode("utf-8") for fn in spec["files"]]
+    matrices = [NamedMatrix.fromFile(fn) for fn in files]
+    ## the true files hold the samples and genes in the order the batches
+    ## were drawn over
+    samples = matrices[0]._rownames
+    genes = matrices[0]._colnames
+    numSamples = spec["numSamples"]
+    lo = bucket * numSamples / buckets
+    hi = (bucket + 1) * numSamples / buckets
+    log("batch %i, null samples %i to %i of %i\n" % (batch, lo, hi, numSamples))
+    nullState["numSamples"] = numSamples
+    nullState["files"] = files
+    nullState["matrices"] = matrices
+    nullState["samples"] = samples
+    nullState["genes"] = genes
+    if engine == "numpy":
+        nullState["block"] = stackMatrices(matrices, samples)
+        writeBatchNumpy(batch - 1, lo, hi, outputPrefix)
+    else:
+        writeBatchPython(batch - 1, lo, hi, outputPrefix)
+
 def createNullFiles(numSamples, files):
     #print hpy().heap()
     matrices = [NamedMatrix.fromFile(filename) for filename in files]
@@ -144,52 +433,51 @@ def createNullFiles(numSamples, files):
     for m in matrices:
         m.restrictColumns(genes)
 
-    for b in range(batches):
-        print "writing batch %i" % (b+1)
-        nullM = [NamedMatrix(m._corner, genes) for m in matrices]
-        prefix = outputPrefix
-        numOffset = 1+ numberingOffset + b*numSamples
-        if batches > 1:
-            prefix += "_" + str(b + 1) +  "_"
-        for i in range(numSamples):
-            geneIndices = range(len(genes))
-            if sameSample:
-                random.shuffle(geneIndices)
-                randomG = geneIndices
-                randomS = [samples[i] for s in geneIndices]
-                sample = samplePrefix + "_" + str(b+1) + "_" + samples[i]
-            else:
-                randomG = [random.choice(geneIndices) for gi in geneIndices]
-                randomS = [random.choice(samples) for s in geneIndices]
-                sample = samplePrefix + str(i + numOffset)
-            for null, m in zip(nullM, matrices):
-                #data = [m[s][g] for s, g in zip(randomS, randomG)]
-                data = array.array('f')
-                for s, g in zip(randomS, randomG):
-                    data.append(m[s][g])
-                null.addSample(sample, data)
-                
-        for fn, m in zip(files, nullM):
-            m.describe()
-            m.writeToFile(outputFileName(prefix, fn))
+    global seed
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2**31 - 1)
+    log("master seed %i\n" % seed)
+    nullState["numSamples"] = numSamples
+    nullState["files"] = files
+    nullState["matrices"] = matrices
+    nullState["samples"] = samples
+    nullState["genes"] = genes
+    if lazySpec is not None:
+        log("writing null spec %s instead of the batches\n" % lazySpec)
+        writeNullSpec(lazySpec, numSamples, files)
+    if engine == "numpy":
+        ## matrix x sample x gene
+        block = stackMatrices(matrices, samples)
+        nullState["block"] = block
+        if lazySpec is None:
+            runBatches(writeBatchNumpy)
+        if trueFileDir != '':
+            for fn, m, values in zip(files, matrices, block):
+                outFileName = os.path.join(trueFileDir, os.path.basename(fn))
+                tabWriter.writeMatrix(outFileName, m._corner, genes, samples, values)
+        return
+
+    if lazySpec is None:
+        runBatches(writeBatchPython)
 
     if trueFileDir != '':
         for fn, m in zip(files, matrices):
-            restrictM = NamedMatrix(m._corner, m._colnames)
-            for s in samples: restrictM.addSample(s, m[s]) 
+            m.restrictRows(samples)
             outFileName = os.path.join(trueFileDir, os.path.basename(fn))
-            restrictM.writeToFile(outFileName)
+            m.writeToFile(outFileName)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv[1:], "s:b:g:qp:o:t:u")
+        opts, args = getopt.getopt(argv[1:], "s:b:g:qp:o:t:ur:e:j:l:S:k:")
     except getopt.GetoptError, err:
         print str(err)
         usage(2)
 
     global geneIntersection
     global minSampleFrac, minGeneFrac, outputPrefix, numberingOffset, verbose
-    global batches, trueFileDir, sameSample
+    global batches, trueFileDir, sameSample, seed, engine, processes, lazySpec
+    specFile = None
+    part = None
     for o, a in opts:
         if o == "-s":
             minSampleFrac = float(a)
@@ -208,6 +496,41 @@ def main(argv):
         if o == "-u":
             geneIntersection = False
             minGeneFrac = 0.0
+        if o == "-r":
+            seed = int(a)
+        if o == "-j":
+            processes = int(a)
+        if o == "-e":
+            if a not in engines:
+                print "unknown engine %s, choose from %s" % (a, ", ".join(engines))
+                usage(1)
+            if a == "numpy" and numpy is None:
+                print "numpy engine requested but numpy is not installed"
+                usage(1)
+            engine = a
+        if o == "-l":
+            lazySpec = a
+        if o == "-S":
+            specFile = a
+        if o == "-k":
+            try:
+                part = [int(v) for v in a.split(",")]
+            except ValueError:
+                part = []
+            if len(part) != 3:
+                print "-k takes batch,k,n"
+                usage(1)
+
+    if specFile is not None:
+        if part is None:
+            print "-S needs the slice to generate given with -k"
+            usage(1)
+        createNullSlice(specFile, part[0], part[1], part[2])
+        return
+
+    if lazySpec is not None and trueFileDir == '':
+        print "-l needs the true files written with -t"
+        usage(1)
 
     if (len(args) < 2):
         print "Not enough arguments: specify number of samples and >=1 file"
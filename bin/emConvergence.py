@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""emConvergence.py: decides when paradigm EM has converged
+
+Follows EM through the parameter files of a run (params0.txt,
+params1.txt, ...): the logZ of each, its relative decrease from the
+previous file, and for every factor the largest change of a parameter.
+An iteration counts as converged when the logZ decrease is under the
+tolerance, or when every factor changed by less than the parameter
+tolerance; EM stops once the last patience iterations have converged,
+or after the maximum number of iterations.
+
+The trajectory is written to em_trace.tsv: one line per parameter file
+with its logZ, decrease, largest change and the change of each factor.
+
+Usage:
+  emConvergence.py [options] [tolerance]
+
+Options:
+  -d float  parameter tolerance (default: not used)
+  -p int    iterations that must converge in a row (default: 1)
+  -i int    most EM iterations (default: no limit)
+
+Run on its own in a run directory, it writes em_trace.tsv and reports
+whether EM has converged at the last parameter file.
+"""
+import os, sys, getopt, re
+
+traceFile = "em_trace.tsv"
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+class Criteria:
+    """
+    When EM stops: the relative logZ decrease under tolerance, or every
+    parameter changing by less than paramTolerance, for patience
+    iterations in a row, or after maxIterations iterations
+    """
+    def __init__(self, tolerance = 0.001, paramTolerance = None, patience = 1,
+                 maxIterations = None):
+        self.tolerance = tolerance
+        self.paramTolerance = paramTolerance
+        self.patience = patience
+        self.maxIterations = maxIterations
+    def converged(self, step):
+        if step["decrease"] is not None and step["decrease"] < self.tolerance:
+            return True
+        return self.paramTolerance is not None and step["maxDelta"] is not None \
+            and step["maxDelta"] < self.paramTolerance
+
+def asCriteria(criteria):
+    """criteria given as a Criteria or as just the logZ tolerance"""
+    if isinstance(criteria, Criteria):
+        return criteria
+    return Criteria(criteria)
+
+def paramsFile(iteration):
+    return "params%i.txt" % iteration
+
+def factorName(header):
+    """the attachment or evidence file a parameter header is for"""
+    m = re.search("child='([^']*)'", header)
+    if m:
+        return m.group(1)
+    return re.split("=", header)[-1]
+
+def readParamFile(filename):
+    """logZ and the parameter values of each factor, in file order"""
+    f = open(filename, "r")
+    m = re.search("logZ=([0-9.e+-]*)", f.readline())
+    logZ = float(m.group(1))
+    factors = []
+    for line in f:
+        if line.isspace():
+            continue
+        if line.startswith(">"):
+            factors.append((factorName(line.rstrip("\r\n")), []))
+        elif len(factors) > 0:
+            ## the value is the last field, older files index it by the bins
+            factors[-1][1].append(float(line.split()[-1]))
+    f.close()
+    return (logZ, factors)
+
+def largestChange(prev, curr):
+    """largest change between two parameter vectors, nan taken as unchanged"""
+    if len(prev) != len(curr):
+        return float("inf")
+    change = 0.0
+    for p, c in zip(prev, curr):
+        if p == p and c == c:
+            change = max(change, abs(c - p))
+    return change
+
+def emTrace(last):
+    """a step for each of params0.txt to params<last>.txt"""
+    steps = []
+    prev = None
+    for i in range(last + 1):
+        (logZ, factors) = readParamFile(paramsFile(i))
+        step = {"iteration" : i, "logZ" : logZ, "decrease" : None,
+                "maxDelta" : None, "deltas" : []}
+        if prev is not None:
+            (prevLogZ, prevFactors) = prev
+            step["decrease"] = (prevLogZ - logZ) / logZ
+            prevValues = dict(prevFactors)
+            for (name, values) in factors:
+                if name in prevValues:
+                    step["deltas"].append((name, largestChange(prevValues[name], values)))
+                else:
+                    step["deltas"].append((name, float("inf")))
+            if len(step["deltas"]) > 0:
+                step["maxDelta"] = max([d for (name, d) in step["deltas"]])
+        steps.append(step)
+        prev = (logZ, factors)
+    return steps
+
+def writeTrace(steps, filename = traceFile):
+    names = []
+    for step in steps:
+        for (name, d) in step["deltas"]:
+            if name not in names:
+                names.append(name)
+    f = open(filename, "w")
+    f.write("\t".join(["iteration", "logZ", "decrease", "maxDelta"] + names) + "\n")
+    for step in steps:
+        deltas = dict(step["deltas"])
+        fields = [str(step["iteration"]), "%g" % step["logZ"]]
+        for v in [step["decrease"], step["maxDelta"]] + [deltas.get(n) for n in names]:
+            if v is None:
+                fields.append("NA")
+            else:
+                fields.append("%g" % v)
+        f.write("\t".join(fields) + "\n")
+    f.close()
+
+def checkConvergence(last, criteria):
+    """
+    Whether EM stops at params<last>.txt, with a line describing the last
+    step; writes em_trace.tsv
+    """
+    steps = emTrace(last)
+    writeTrace(steps)
+    step = steps[-1]
+    status = "iteration %i, logZ: %5g" % (last, step["logZ"])
+    if step["decrease"] is not None:
+        status += ", Decrease: %3g" % (100*step["decrease"])
+    if step["maxDelta"] is not None:
+        status += ", largest parameter change: %g" % step["maxDelta"]
+    if criteria.maxIterations is not None and last >= criteria.maxIterations:
+        return (True, status + ", reached %i iterations" % criteria.maxIterations)
+    recent = steps[-criteria.patience:]
+    if len(recent) == criteria.patience and all([criteria.converged(s) for s in recent]):
+        return (True, status + ", converged")
+    return (False, status)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "d:p:i:")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) > 1:
+        print "incorrect number of arguments"
+        usage(1)
+    criteria = Criteria()
+    if len(args) == 1:
+        criteria.tolerance = float(args[0])
+    for o, a in opts:
+        if o == "-d":
+            criteria.paramTolerance = float(a)
+        elif o == "-p":
+            criteria.patience = int(a)
+        elif o == "-i":
+            criteria.maxIterations = int(a)
+    last = 0
+    while os.path.exists(paramsFile(last + 1)):
+        last += 1
+    (stop, status) = checkConvergence(last, criteria)
+    print status
+    if not stop:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
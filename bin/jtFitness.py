@@ -13,6 +13,7 @@ Options:
 ## Written By: Sam Ng
 import math, os, os.path, sys, random, re, types
 
+import tabWriter
 from wrapParadigm import prepareParadigm
 from wrapParadigm import jtParadigm
 from jtParadigm import *
@@ -83,17 +84,29 @@ def retRows(inf, delim = "\t"):
         rows.append(re.split(delim, line)[0])
     return(rows)
 
-def rwCRSData(outf, inf, delim = "\t", null = "NA", useCols = None, useRows = None, colMap = {}, rowMap = {}, enumerateRows = False):
-    """reads and writes .tsv"""
-    colFeatures = []
-    ## read header
+def iterCRSData(inf, delim = "\t"):
+    """
+    yields the split lines of a .tsv; the cells are copied as they are, so
+    they are read from the text and not from its matrixCache
+    """
     f = openAnyFile(inf)
-    o = open(outf, "w")
     line = f.readline()
     if line.isspace():
         log("ERROR: encountered a blank on line 1\n", die = True)
-    line = line.rstrip("\r\n")
-    pline = re.split(delim, line)
+    yield re.split(delim, line.rstrip("\r\n"))
+    for line in f:
+        if line.isspace():
+            continue
+        yield re.split(delim, line.rstrip("\r\n"))
+    f.close()
+
+def rwCRSData(outf, inf, delim = "\t", null = "NA", useCols = None, useRows = None, colMap = {}, rowMap = {}, enumerateRows = False):
+    """reads and writes .tsv"""
+    colFeatures = []
+    ## read header
+    lines = iterCRSData(inf, delim)
+    o = tabWriter.TabWriter(outf, delim, null)
+    pline = lines.next()
     lineLength = len(pline)
     colIndex = {}
     for i, col in enumerate(pline[1:]):
@@ -102,17 +115,20 @@ def rwCRSData(outf, inf, delim = "\t", null = "NA", useCols = None, useRows = No
             if col not in useCols:
                 continue
         colFeatures.append(col)
-    o.write("id%s\n" % (delim+delim.join(colFeatures)))
+    o.writeHeader("id", colFeatures)
+    fieldIndex = []
+    for col in colFeatures:
+        if col in colMap:
+            mcol = colMap[col]
+        else:
+            mcol = col
+        fieldIndex.append(colIndex[mcol]+1)
     ## read and write data
     rowCount = 0
     if enumerateRows:
         m = open("%s.idmap" % (outf))
-    for line in f:
-        if line.isspace():
-            continue
+    for pline in lines:
         rowCount += 1
-        line = line.rstrip("\r\n")
-        pline = re.split(delim, line)
         if pline[0] in rowMap:
             mrow = rowMap[pline[0]]
         else:
@@ -123,21 +139,11 @@ def rwCRSData(outf, inf, delim = "\t", null = "NA", useCols = None, useRows = No
         if len(pline) != lineLength:
             log("ERROR: length of line does not match the rest of the file\n", die = True)
         if enumerateRows:
-            o.write("r%s" % (rowCount))
+            label = "r%s" % (rowCount)
             m.write("r%s\t%s\n" % (rowCount, mrow))
         else:
-            o.write("%s" % (mrow))
-        for col in colFeatures:
-            if col in colMap:
-                mcol = colMap[col]
-            else:
-                mcol = col
-            if pline[colIndex[mcol]+1] == "":
-                o.write("%s" % (delim+null))
-            else:            
-                o.write("%s" % (delim+pline[colIndex[mcol]+1]))
-        o.write("\n")
-    f.close()
+            label = mrow
+        o.writeFields(label, [pline[i] for i in fieldIndex])
     o.close()
     if enumerateRows:
         m.close()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""localParadigm.py: run a prepared paradigm directory on this machine
+
+Runs the same EM iterations, final run and merge as jtParadigm.py, but
+with a local process pool instead of jobTree, so a workstation needs no
+batch system or job database.  Run it in a directory set up by
+prepareParadigm.py.
+
+The stderr of every paradigm command goes to jobLogs/, named after its
+output file, and a line of progress (jobs done, jobs per second and the
+time left at that rate) is kept up to date on stderr.
+
+Jobs that are done are not run again (see paradigmJobs.jobKey), so a run
+that was stopped picks up where it was when started again.
+
+Usage:
+  localParadigm.py [options] [tolerance]
+
+Options:
+  -j int    cores to use (default: number of cpus)
+  -c int    cores each job takes (default: 1)
+  -m int    memory to use in MB (default: physical memory)
+  -M int    memory each job may take in MB; jobs that go over it fail
+            (default: no limit, jobs are only limited by -j and -c)
+  -r int    times a failed command is tried again (default: 2)
+  -b float  seconds before the first retry, doubled for each further
+            retry (default: 10)
+  -f        run every job, also those done before
+  -d float  stop EM once no parameter changes by more than this
+  -p int    EM iterations that must converge in a row (default: 1)
+  -i int    most EM iterations (default: no limit)
+  -q        run quietly
+"""
+import os, sys, getopt, time, resource, shutil, signal
+import multiprocessing
+import paradigmJobs
+import emConvergence
+from paradigmJobs import pendingJobs
+
+verbose = True
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def physicalMemory():
+    """MB of physical memory, None if it cannot be found"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def workerSlots(cores, jobCores, memory, jobMemory):
+    """number of jobs that fit in the core and memory budgets at once"""
+    slots = max(1, cores / max(1, jobCores))
+    if memory is not None and jobMemory > 0:
+        slots = min(slots, max(1, memory / jobMemory))
+    return slots
+
+## seconds the runner waits for a job at a time; waiting without a
+## timeout would not let an interrupt through
+waitTimeout = 60
+
+def initWorker(jobMemory):
+    ## interrupts are handled by the runner, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    resource.setrlimit(resource.RLIMIT_CORE, (0,0))
+    if jobMemory > 0:
+        limit = jobMemory * (1 << 20)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def formatSeconds(seconds):
+    seconds = int(seconds)
+    return "%i:%02i:%02i" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+class Progress:
+    """
+    Reports jobs done, jobs per second and the time left on stderr; on a
+    terminal the line is rewritten in place, otherwise a line is written
+    every interval seconds
+    """
+    def __init__(self, label, total, interval = 60.0):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self.last = self.start
+        self.interval = interval
+        self.tty = sys.stderr.isatty()
+    def line(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        rate = self.done / elapsed
+        if rate > 0:
+            eta = formatSeconds((self.total - self.done) / rate)
+        else:
+            eta = "?"
+        failed = ""
+        if self.failed > 0:
+            failed = ", %i failed" % self.failed
+        return "%s: %i/%i jobs%s, %.2f jobs/s, %s elapsed, ETA %s" \
+            % (self.label, self.done, self.total, failed, rate,
+               formatSeconds(elapsed), eta)
+    def update(self, failed = False):
+        self.done += 1
+        if failed:
+            self.failed += 1
+        if self.tty:
+            log("\r%s" % self.line())
+        elif time.time() - self.last >= self.interval:
+            self.last = time.time()
+            log("%s\n" % self.line())
+    def finish(self):
+        if self.tty:
+            log("\r%s\n" % self.line())
+        else:
+            log("%s\n" % self.line())
+
+def runJob(args):
+    """runs one job line, returns (job, error)"""
+    (job, keys, retries, backoff) = args
+    try:
+        paradigmJobs.runJob(job, retries, backoff, keys)
+    except Exception, err:
+        return (job, str(err))
+    return (job, None)
+
+def nextResult(results):
+    while True:
+        try:
+            return results.next(waitTimeout)
+        except multiprocessing.TimeoutError:
+            pass
+
+def runJobList(pool, filename, retries, backoff):
+    """runs a job list longest first, exits if any of its jobs fail"""
+    (jobs, done) = pendingJobs(filename)
+    if done > 0:
+        log("skipping %i jobs of %s done before\n" % (done, filename))
+    if len(jobs) == 0:
+        return
+    progress = Progress(filename, len(jobs))
+    failed = []
+    tasks = [(job, keys, retries, backoff) for (job, keys) in jobs]
+    results = pool.imap_unordered(runJob, tasks, 1)
+    for i in range(len(tasks)):
+        (job, error) = nextResult(results)
+        if error is not None:
+            if progress.tty:
+                log("\n")
+            log("job failed: %s\n" % error)
+            failed.append(job)
+        progress.update(error is not None)
+    progress.finish()
+    if len(failed) > 0:
+        print "%d jobs of %s failed, see %s/" % (len(failed), filename, paradigmJobs.logDir)
+        sys.exit(1)
+
+def runParadigm(pool, criteria, retries, backoff, cores, memory):
+    iteration = 0
+    while True:
+        log("EM iteration %i\n" % iteration)
+        paradigmJobs.startExpectation(iteration)
+        runJobList(pool, "jobsEM.list", retries, backoff)
+        paradigmJobs.collectParameters(iteration)
+        (stop, status) = emConvergence.checkConvergence(iteration + 1, criteria)
+        log("%s\n" % status)
+        if stop:
+            break
+        iteration += 1
+    paradigmJobs.cacheParameters(iteration + 1)
+    log("final run with params%i.txt\n" % (iteration + 1))
+    paradigmJobs.startFinalRun(iteration + 1)
+    runJobList(pool, "jobs.list", retries, backoff)
+    log("merging\n")
+    paradigmJobs.mergeOutputs(cores, memory)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "j:c:m:M:r:b:fd:p:i:q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) > 1:
+        print "incorrect number of arguments"
+        usage(1)
+    criteria = emConvergence.Criteria()
+    if len(args) == 1:
+        criteria.tolerance = float(args[0])
+    cores = multiprocessing.cpu_count()
+    jobCores = 1
+    memory = physicalMemory()
+    jobMemory = 0
+    retries = 2
+    backoff = 10.0
+    rerun = False
+    global verbose
+    for o, a in opts:
+        if o == "-j":
+            cores = int(a)
+        elif o == "-c":
+            jobCores = int(a)
+        elif o == "-m":
+            memory = int(a)
+        elif o == "-M":
+            jobMemory = int(a)
+        elif o == "-r":
+            retries = int(a)
+        elif o == "-b":
+            backoff = float(a)
+        elif o == "-f":
+            rerun = True
+        elif o == "-d":
+            criteria.paramTolerance = float(a)
+        elif o == "-p":
+            criteria.patience = int(a)
+        elif o == "-i":
+            criteria.maxIterations = int(a)
+        elif o == "-q":
+            verbose = False
+
+    paradigmJobs.checkRunDirectory()
+    if rerun:
+        shutil.rmtree(paradigmJobs.doneDir, True)
+    slots = workerSlots(cores, jobCores, memory, jobMemory)
+    log("running %i jobs at a time\n" % slots)
+    pool = multiprocessing.Pool(slots, initWorker, (jobMemory,))
+    try:
+        runParadigm(pool, criteria, retries, backoff, cores, memory)
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        print "interrupted, run again to resume"
+        sys.exit(130)
+    pool.close()
+    pool.join()
+    log("Run complete!\n")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""matrixCache.py: binary sidecar caches for tab-separated evidence matrices
+
+A cache sits next to the text file it was parsed from:
+  <file>.cache.f64    row-major float64 values, missing values stored as nan
+  <file>.cache.json   corner, row and column names, plus the size, mtime and
+                      sha1 of the text file when the cache was written
+
+Values are kept as doubles so every reader gets exactly the number it would
+have parsed from the text, whether it keeps floats or float32 arrays.
+loadCache() only hands back a cache whose text file is unchanged (same size
+and mtime, or same sha1), so readers can try it first and fall back to
+parsing the text.
+
+Usage:
+  matrixCache.py [options] file [file ...]
+
+Options:
+  -q    run quietly
+"""
+import os, sys, getopt, array, json, hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+verbose = True
+
+dataSuffix = ".cache.f64"
+indexSuffix = ".cache.json"
+cacheVersion = 1
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def cachePaths(filename):
+    """returns the data and index file of the cache of filename"""
+    return (filename + dataSuffix, filename + indexSuffix)
+
+def fileDigest(filename, blockSize = 1 << 20):
+    """sha1 of a file"""
+    digest = hashlib.sha1()
+    f = open(filename, "rb")
+    while True:
+        block = f.read(blockSize)
+        if not block:
+            break
+        digest.update(block)
+    f.close()
+    return digest.hexdigest()
+
+def parseValues(fields):
+    """float values of a row, fields that do not parse become nan"""
+    if numpy is not None:
+        try:
+            return numpy.array(fields, dtype = numpy.float64)
+        except ValueError:
+            pass
+    vals = array.array("d")
+    for v in fields:
+        try:
+            vals.append(float(v))
+        except ValueError:
+            vals.append(float("nan"))
+    if numpy is not None:
+        return numpy.frombuffer(vals.tostring(), dtype = numpy.float64)
+    return vals
+
+def parseMatrix(filename, sep = "\t"):
+    """
+    Parses a tab file; returns corner, row names, column names and the
+    values as a list of float rows, or None if the rows are ragged
+    """
+    f = open(filename, "r")
+    header = f.readline().rstrip("\r\n").split(sep)
+    rows = []
+    values = []
+    for line in f:
+        vals = line.rstrip("\r\n").split(sep)
+        if len(vals) != len(header):
+            f.close()
+            return None
+        rows.append(vals[0])
+        values.append(parseValues(vals[1:]))
+    f.close()
+    return (header[0], rows, header[1:], values)
+
+def writeCache(filename, sep = "\t", parsed = None):
+    """
+    Writes the cache of filename, parsing it unless parsed holds its
+    (corner, rows, cols, values); returns False if it could not be cached
+    """
+    if parsed is None:
+        parsed = parseMatrix(filename, sep)
+        if parsed is None:
+            log("not caching %s: rows of unequal length\n" % (filename))
+            return False
+    (corner, rows, cols, values) = parsed
+    (dataFile, indexFile) = cachePaths(filename)
+    if os.path.exists(indexFile):
+        os.remove(indexFile)
+    o = open(dataFile + ".tmp", "wb")
+    for row in values:
+        if numpy is not None:
+            numpy.asarray(row, dtype = numpy.float64).tofile(o)
+        else:
+            array.array("d", row).tofile(o)
+    o.close()
+    os.rename(dataFile + ".tmp", dataFile)
+    stat = os.stat(filename)
+    index = {"version" : cacheVersion,
+             "size" : stat.st_size,
+             "mtime" : stat.st_mtime,
+             "sha1" : fileDigest(filename),
+             "sep" : sep,
+             "corner" : corner,
+             "rows" : rows,
+             "cols" : cols}
+    o = open(indexFile + ".tmp", "w")
+    json.dump(index, o)
+    o.close()
+    os.rename(indexFile + ".tmp", indexFile)
+    return True
+
+class CachedMatrix:
+    """
+    A cached matrix; values is a numRows x numCols float64 memmap, or a
+    flat array.array("d") when numpy is not available
+    """
+    def __init__(self, index, dataFile):
+        ## json hands back unicode, readers expect the bytes of the text file
+        self.corner = index["corner"].encode("utf-8")
+        self.rows = [r.encode("utf-8") for r in index["rows"]]
+        self.cols = [c.encode("utf-8") for c in index["cols"]]
+        self.numRows = len(self.rows)
+        self.numCols = len(self.cols)
+        if numpy is not None:
+            if self.numRows * self.numCols > 0:
+                self.values = numpy.memmap(dataFile, dtype = numpy.float64,
+                                           mode = "r", shape = (self.numRows, self.numCols))
+            else:
+                self.values = numpy.zeros((self.numRows, self.numCols), dtype = numpy.float64)
+        else:
+            self.values = array.array("d")
+            f = open(dataFile, "rb")
+            self.values.fromfile(f, self.numRows * self.numCols)
+            f.close()
+    def getRow(self, i):
+        """row i as an array.array("f")"""
+        if numpy is not None:
+            vals = array.array("f")
+            vals.fromstring(self.values[i].astype(numpy.float32).tostring())
+            return vals
+        return array.array("f", self.values[i*self.numCols:(i+1)*self.numCols])
+    def getValues(self):
+        """all values, row-major, as one flat array.array("f")"""
+        if numpy is not None:
+            vals = array.array("f")
+            vals.fromstring(self.values.astype(numpy.float32).tostring())
+            return vals
+        return array.array("f", self.values)
+    def getRowStrings(self, i, null = "NA"):
+        """row i as the shortest text of each value, missing values as null"""
+        if numpy is not None:
+            row = self.values[i].tolist()
+        else:
+            row = self.values[i*self.numCols:(i+1)*self.numCols]
+        out = []
+        for v in row:
+            if v != v:
+                out.append(null)
+            else:
+                out.append(repr(v))
+        return out
+
+def loadCache(filename, sep = "\t"):
+    """returns the CachedMatrix of filename, or None if missing or stale"""
+    (dataFile, indexFile) = cachePaths(filename)
+    if not os.path.exists(indexFile) or not os.path.exists(dataFile):
+        return None
+    try:
+        f = open(indexFile, "r")
+        index = json.load(f)
+        f.close()
+    except ValueError:
+        return None
+    if index.get("version") != cacheVersion or index.get("sep") != sep:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if stat.st_size != index["size"]:
+        return None
+    if stat.st_mtime != index["mtime"] and fileDigest(filename) != index["sha1"]:
+        return None
+    if os.path.getsize(dataFile) != 8 * len(index["rows"]) * len(index["cols"]):
+        return None
+    return CachedMatrix(index, dataFile)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) == 0:
+        print "incorrect number of arguments"
+        usage(1)
+    global verbose
+    for o, a in opts:
+        if o == "-q":
+            verbose = False
+    for filename in args:
+        if loadCache(filename) is None:
+            log("caching %s\n" % (filename))
+            writeCache(filename)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
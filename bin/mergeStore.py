@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""mergeStore.py: binary store of merged paradigm results
+
+A store directory holds a block for each pathway:
+  <pid>.f32     entities x samples float32 values, row-major
+  <pid>.json    the entities and samples (the sample headers of the
+                merged_transpose_ table) of the block
+Blocks are added a pathway at a time, by mergeSwarmFiles.py -s or from
+merged_transpose_ files with -a; as every pathway has its own files,
+parallel merges can fill one store.
+
+The export writes merge_merged.tab (without the na_ null samples) and
+merge_merged.all.tab, the tables merge_merged.py assembles from the text
+files, in one pass over the store holding one block at a time.  Rows come
+in pathway order, the samples in the order they are first seen; a
+sample a pathway has no value for is left empty.  Values are written as
+str() of their float32, the text mergeSwarmFiles.py writes for them.
+
+Usage:
+  mergeStore.py [options] storeDir
+
+Options:
+  -a dir    add the merged_transpose_ files under dir to the store
+  -e        write merge_merged.tab and merge_merged.all.tab (the default
+            without -a)
+  -q        run quietly
+"""
+import os, sys, getopt, fnmatch, array, json, operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+verbose = True
+
+dataSuffix = ".f32"
+indexSuffix = ".json"
+storeVersion = 1
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def blockPaths(storeDir, pid):
+    """returns the data and index file of the block of pid"""
+    base = os.path.join(storeDir, pid)
+    return (base + dataSuffix, base + indexSuffix)
+
+def sampleName(header):
+    """the sample of a sample header, "<sample> loglikelihood=..." """
+    return header.split(" ")[0]
+
+def writeBlock(storeDir, pid, entities, samples, values):
+    """
+    Adds the block of pid to a store, replacing any block it had; values
+    is an entities x samples array, or a list of array("f") rows
+    """
+    (dataFile, indexFile) = blockPaths(storeDir, pid)
+    if os.path.exists(indexFile):
+        os.remove(indexFile)
+    o = open(dataFile + ".tmp", "wb")
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        numpy.asarray(values, dtype = numpy.float32).tofile(o)
+    else:
+        for row in values:
+            array.array("f", row).tofile(o)
+    o.close()
+    os.rename(dataFile + ".tmp", dataFile)
+    ## the index is written last, a block without one is not in the store
+    index = {"version" : storeVersion,
+             "pid" : pid,
+             "entities" : entities,
+             "samples" : samples}
+    o = open(indexFile + ".tmp", "w")
+    json.dump(index, o)
+    o.close()
+    os.rename(indexFile + ".tmp", indexFile)
+
+class Block:
+    """
+    The block of a pathway; values is a numEntities x numSamples float32
+    memmap, or a flat array.array("f") when numpy is not available
+    """
+    def __init__(self, index, dataFile):
+        ## json hands back unicode, the tables are written as bytes
+        self.pid = index["pid"].encode("utf-8")
+        self.entities = [e.encode("utf-8") for e in index["entities"]]
+        self.samples = [s.encode("utf-8") for s in index["samples"]]
+        self.numEntities = len(self.entities)
+        self.numSamples = len(self.samples)
+        self.dataFile = dataFile
+        self.values = None
+    def load(self):
+        if numpy is not None:
+            if self.numEntities * self.numSamples > 0:
+                self.values = numpy.memmap(self.dataFile, dtype = numpy.float32, mode = "r",
+                                           shape = (self.numEntities, self.numSamples))
+            else:
+                self.values = numpy.zeros((self.numEntities, self.numSamples),
+                                          dtype = numpy.float32)
+        else:
+            self.values = array.array("f")
+            f = open(self.dataFile, "rb")
+            self.values.fromfile(f, self.numEntities * self.numSamples)
+            f.close()
+    def release(self):
+        self.values = None
+    def getRowStrings(self, i):
+        """row i as str() of each value"""
+        if self.values is None:
+            self.load()
+        if numpy is not None:
+            return map(str, self.values[i].tolist())
+        return map(str, self.values[i*self.numSamples:(i+1)*self.numSamples].tolist())
+
+def loadBlock(storeDir, pid):
+    """returns the Block of pid, or None if it is missing or incomplete"""
+    (dataFile, indexFile) = blockPaths(storeDir, pid)
+    if not os.path.exists(indexFile) or not os.path.exists(dataFile):
+        return None
+    try:
+        f = open(indexFile, "r")
+        index = json.load(f)
+        f.close()
+    except ValueError:
+        return None
+    if index.get("version") != storeVersion:
+        return None
+    if os.path.getsize(dataFile) != 4 * len(index["entities"]) * len(index["samples"]):
+        return None
+    return Block(index, dataFile)
+
+def storeBlocks(storeDir):
+    """the blocks of a store, in pathway order"""
+    blocks = []
+    for name in sorted(os.listdir(storeDir)):
+        if not name.endswith(indexSuffix):
+            continue
+        block = loadBlock(storeDir, name[:-len(indexSuffix)])
+        if block is None:
+            log("skipping incomplete block %s\n" % (name))
+            continue
+        blocks.append(block)
+    return blocks
+
+def sampleIndex(blocks, keep = lambda sample: True):
+    """the samples of blocks that keep accepts, in the order first seen"""
+    samples = []
+    columns = {}
+    for block in blocks:
+        for header in block.samples:
+            sample = sampleName(header)
+            if sample not in columns and keep(header):
+                columns[sample] = len(samples)
+                samples.append(sample)
+    return (samples, columns)
+
+def gatherColumns(block, samples, columns):
+    """
+    for each of the samples, the column of block holding it, or
+    block.numSamples if it has none (the last one of a sample seen twice)
+    """
+    gather = [block.numSamples] * len(samples)
+    for j, header in enumerate(block.samples):
+        c = columns.get(sampleName(header))
+        if c is not None:
+            gather[c] = j
+    return gather
+
+def gatherRow(row, gather):
+    """the values of row in the columns of gather, "" for none"""
+    if len(gather) == 0:
+        return []
+    if len(gather) == 1:
+        return [(row + [""])[gather[0]]]
+    return operator.itemgetter(*gather)(row + [""])
+
+def exportTables(storeDir, resultName = "merge_merged.tab",
+                 allName = "merge_merged.all.tab"):
+    """writes the tables of a store, see the module documentation"""
+    ## merge_merged.py leaves out the example pathway
+    blocks = [b for b in storeBlocks(storeDir) if b.pid != "example"]
+    (allSamples, allColumns) = sampleIndex(blocks)
+    (samples, columns) = sampleIndex(blocks, lambda s: not s.startswith("na_"))
+
+    resultFile = open(resultName, "w")
+    resultFile.write("pid_entity\t" + "\t".join(samples) + "\n")
+    allFile = open(allName, "w")
+    allFile.write("pid_entity\t" + "\t".join(allSamples) + "\n")
+    rows = 0
+    for block in blocks:
+        resultGather = gatherColumns(block, samples, columns)
+        allGather = gatherColumns(block, allSamples, allColumns)
+        allInOrder = allGather == range(block.numSamples)
+        for i, entity in enumerate(block.entities):
+            name = block.pid + "_" + entity
+            row = block.getRowStrings(i)
+            resultFile.write(name + "\t" + "\t".join(gatherRow(row, resultGather)) + "\n")
+            if allInOrder:
+                allFile.write(name + "\t" + "\t".join(row) + "\n")
+            else:
+                allFile.write(name + "\t" + "\t".join(gatherRow(row, allGather)) + "\n")
+        rows += block.numEntities
+        block.release()
+    resultFile.close()
+    allFile.close()
+    log("wrote %i rows of %i pathways to %s and %s\n"
+        % (rows, len(blocks), resultName, allName))
+
+def transposedFiles(directory):
+    """the merged_transpose_ files under directory, as merge_merged.py finds them"""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if fnmatch.fnmatch(path, "*_transpose_*"):
+                files.append(path)
+    return files
+
+def addTransposed(storeDir, filename):
+    """adds a merged_transpose_ file to a store, returns its pid"""
+    pid = filename[:-4].split("_").pop()
+    f = open(filename, "r")
+    samples = f.readline().rstrip("\r\n").split("\t")[1:]
+    entities = []
+    values = []
+    for line in f:
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) != len(samples) + 1:
+            f.close()
+            raise ValueError("%s: %i values for %i samples"
+                             % (filename, len(fields) - 1, len(samples)))
+        entities.append(fields[0])
+        row = array.array("f")
+        for v in fields[1:]:
+            try:
+                row.append(float(v))
+            except ValueError:
+                row.append(float("nan"))
+        values.append(row)
+    f.close()
+    writeBlock(storeDir, pid, entities, samples, values)
+    return pid
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "a:eq")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        print "incorrect number of arguments"
+        usage(1)
+    storeDir = args[0]
+    addDir = None
+    export = False
+    global verbose
+    for o, a in opts:
+        if o == "-a":
+            addDir = a
+        elif o == "-e":
+            export = True
+        elif o == "-q":
+            verbose = False
+    if addDir is not None:
+        if not os.path.exists(storeDir):
+            os.makedirs(storeDir)
+        added = 0
+        for filename in transposedFiles(addDir):
+            addTransposed(storeDir, filename)
+            added += 1
+        log("added %i pathways of %s to %s\n" % (added, addDir, storeDir))
+    if export or addDir is None:
+        exportTables(storeDir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
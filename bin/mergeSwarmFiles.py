@@ -1,18 +1,73 @@
 #!/usr/bin/env python
 
-import sys, os, string, fnmatch
+import sys, os, string, fnmatch, re, warnings, getopt, signal
 import array
+import multiprocessing, Queue
+import mergeStore
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+## bytes of an output file read at a time
+chunkSize = 1 << 22
+
+## bytes a merge takes per byte of its output files (the float32 block,
+## the values read and the rows being written)
+memoryFactor = 3
+
+## the name and value of each line of a record
+recordLine = re.compile("^([^\t\n]*)\t([^\t\n]*)", re.M)
+
+def physicalMemory():
+    """MB of physical memory, None if it cannot be found"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def listDirectory(directory):
+    """
+    (files, directories) of a directory in directory order; like os.walk,
+    links to directories are neither files nor followed
+    """
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if not entry.is_dir():
+                files.append(entry.path)
+            elif not entry.is_symlink():
+                dirs.append(entry.path)
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                files.append(path)
+            elif not os.path.islink(path):
+                dirs.append(path)
+    return (files, dirs)
 
 def getFilesMatching(baseDir, patterns):
+    """
+    Paths under baseDir matching any of the patterns, found in one pass
+    over the tree in the order of os.walk
+    """
+    match = re.compile("|".join(["(?:%s)" % fnmatch.translate(p) for p in patterns]))
     list = []
-    
-    for root, dirs, files in os.walk(baseDir):
-        for file in files:
-            ptr = os.path.join(root, file)        
-            for pattern in patterns:
-                if fnmatch.fnmatch(ptr, pattern):
-                    list.append(ptr)
-                    
+    pending = [baseDir]
+    while len(pending) > 0:
+        (files, dirs) = listDirectory(pending.pop(0))
+        list += [f for f in files if match.match(f)]
+        pending = dirs + pending
     return list 
 
 
@@ -132,122 +187,356 @@ def outputDataTranspose(outname, sampleData):
     outFile.close()
 """    
     
-def outputData(outname, sampleData, col_map):
-    entities = col_map.keys()
-    entities.sort(key=lambda x : col_map[x])
-
-    sampleNames = sampleData.keys()
+def faRecords(fname):
+    """
+    (sample id, record text) of each record of a paradigm output file, read
+    a chunk at a time; text before the first record is skipped
+    """
+    inFile = open(fname)
+    rest = "\n"
+    while True:
+        chunk = inFile.read(chunkSize)
+        if not chunk:
+            break
+        text = rest + chunk
+        end = text.rfind("\n>")
+        if end <= 0:
+            rest = text
+            continue
+        rest = text[end:]
+        for record in text[:end].split("\n>")[1:]:
+            (header, newline, body) = record.partition("\n")
+            yield (header.rstrip().strip('>').strip(), body)
+    inFile.close()
+    for record in rest.split("\n>")[1:]:
+        (header, newline, body) = record.partition("\n")
+        yield (header.rstrip().strip('>').strip(), body)
+
+def recordFields(body):
+    """the names and values of the lines of a record"""
+    body = body.rstrip("\n")
+    fields = body.replace("\t", "\n").split("\n")
+    ## one tab on every line, as paradigm writes them
+    if len(fields) == 2 * (body.count("\n") + 1):
+        return (fields[0::2], fields[1::2])
+    pairs = recordLine.findall(body)
+    return ([name for (name, value) in pairs], [value for (name, value) in pairs])
+
+def parseFloats(values):
+    """floats of value strings, nan for those that are not numbers"""
+    if numpy is not None:
+        text = " ".join(values)
+        ## fromstring stops at the first value that is not a number
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            floats = numpy.fromstring(text, sep = " ")
+        if len(floats) == len(values) and text.count(" ") == len(values) - 1 \
+                and "" not in values:
+            return floats
+    try:
+        return [float(v) for v in values]
+    except ValueError:
+        floats = []
+        for v in values:
+            try:
+                floats.append(float(v))
+            except ValueError:
+                floats.append(float('nan'))
+        return floats
+
+def growBlock(block, rows, cols):
+    """block copied into a zero block of at least rows x cols, grown by half"""
+    (oldRows, oldCols) = block.shape
+    if rows > oldRows:
+        rows = max(rows, oldRows + oldRows / 2)
+    if cols > oldCols:
+        cols = max(cols, oldCols + oldCols / 2)
+    grown = numpy.zeros((max(rows, oldRows), max(cols, oldCols)), dtype = numpy.float32)
+    grown[:oldRows, :oldCols] = block
+    return grown
+
+def readGroup(files):
+    """
+    The samples of the output files of a pathway: a sample id to row map,
+    the entities in the order first seen, and a samples x entities float32
+    block (an array('f') per row without numpy).  Entities a sample has no
+    value for are 0; a sample seen again is read anew.
+
+    Each record is written straight into its row.  The block is allocated
+    at the first record, with as many rows as records of its size fit in
+    the files, and only grows when a record brings a sample or entity
+    that does not fit.
+    """
+    sampleRow = {}
+    entities = []
+    entityCol = {}
+    block = None
+    totalBytes = sum([os.path.getsize(f) for f in files])
+    lastNames = None
+    for fname in files:
+        for (sample, body) in faRecords(fname):
+            (names, values) = recordFields(body)
+            ## the records of a pathway list the same entities, look them
+            ## up once
+            if names != lastNames:
+                lastNames = names
+                keep = [i for i, name in enumerate(names) if "__" not in name]
+                for i in keep:
+                    if names[i] not in entityCol:
+                        entityCol[names[i]] = len(entities)
+                        entities.append(names[i])
+                cols = [entityCol[names[i]] for i in keep]
+                if numpy is not None:
+                    keep = numpy.array(keep, dtype = int)
+                    cols = numpy.array(cols, dtype = int)
+            values = parseFloats(values)
+            if numpy is not None:
+                values = numpy.asarray(values, dtype = numpy.float32)
+                if len(keep) != len(values):
+                    values = values[keep]
+            else:
+                values = array.array("f", [values[i] for i in keep])
+
+            if sample in sampleRow:
+                row = sampleRow[sample]
+                fresh = False
+            else:
+                row = len(sampleRow)
+                sampleRow[sample] = row
+                fresh = True
+            if numpy is not None:
+                if block is None:
+                    recordBytes = len(sample) + len(body) + 2
+                    block = numpy.zeros((max(1, totalBytes / recordBytes), len(entities)),
+                                        dtype = numpy.float32)
+                elif row >= block.shape[0] or len(entities) > block.shape[1]:
+                    block = growBlock(block, row + 1, len(entities))
+                if not fresh:
+                    block[row] = 0
+                block[row, cols] = values
+            else:
+                if block is None:
+                    block = []
+                if fresh:
+                    block.append(array.array("f", [0.0]) * len(entities))
+                else:
+                    block[row] = array.array("f", [0.0]) * len(entities)
+                if len(block[row]) < len(entities):
+                    block[row].extend([0.0] * (len(entities) - len(block[row])))
+                for c, v in zip(cols, values):
+                    block[row][c] = v
+
+    if numpy is not None:
+        if block is None:
+            block = numpy.zeros((0, 0), dtype = numpy.float32)
+        return (sampleRow, entities, block[:len(sampleRow), :len(entities)])
+    if block is None:
+        block = []
+    for r in block:
+        if len(r) < len(entities):
+            r.extend([0.0] * (len(entities) - len(r)))
+    return (sampleRow, entities, block)
+
+def sortedSamples(sampleRow):
+    sampleNames = sampleRow.keys()
     sampleNames.sort()
     sampleNames.reverse() # put "sample" on top
-   
-    s = "id" + '\t' + '\t'.join(entities) + '\n'
-
-    outFile = open(outname, 'w')
-    outFile.write(s)
-    for sample in sampleNames:
-        data = []
-        for e in entities:
-            data.append( str(sampleData[sample][col_map[e]]) )
-        s = sample + '\t' + '\t'.join(data) + '\n'
-        outFile.write(s)
-    outFile.close()
-
-def outputDataTranspose(outname, sampleData, col_map):
-    entities = col_map.keys()
-    entities.sort(key=lambda x : col_map[x])
-
-    sampleNames = sampleData.keys()
-    sampleNames.sort()
-    sampleNames.reverse() # put "sample" on top
-   
-    s = "id" + '\t' + '\t'.join(sampleNames) + '\n'
-
-    outFile = open(outname, 'w')
-    outFile.write(s)
-    for e in entities:
-        data = []
-        for sample in sampleNames:
-            data.append( str(sampleData[sample][col_map[e]]) )
-        s = e + '\t' + '\t'.join(data) + '\n'
-        outFile.write(s)
-    outFile.close()
+    return sampleNames
+
+def formatBlock(block, rows):
+    """the given rows of a block as lists of value strings"""
+    if numpy is not None:
+        rows = block[rows].tolist()
+    else:
+        rows = [block[r].tolist() for r in rows]
+    return [map(str, row) for row in rows]
+
+def outputData(outname, outnameTranspose, sampleRow, entities, block):
+    """
+    Writes the samples x entities table to outname and its transpose to
+    outnameTranspose, either may be None; the values are formatted once
+    for both
+    """
+    sampleNames = sortedSamples(sampleRow)
+    data = formatBlock(block, [sampleRow[sample] for sample in sampleNames])
+
+    if outname is not None:
+        outFile = open(outname, 'w')
+        outFile.write("id" + '\t' + '\t'.join(entities) + '\n')
+        outFile.writelines([sample + '\t' + '\t'.join(row) + '\n'
+                            for sample, row in zip(sampleNames, data)])
+        outFile.close()
+
+    if outnameTranspose is not None:
+        outFile = open(outnameTranspose, 'w')
+        outFile.write("id" + '\t' + '\t'.join(sampleNames) + '\n')
+        if len(data) > 0:
+            outFile.writelines([e + '\t' + '\t'.join(column) + '\n'
+                                for e, column in zip(entities, zip(*data))])
+        outFile.close()
 
     
-def mergeGroups(outdirectory, groups):
-
-    for g,files in groups.iteritems():        
-        sampleData = {}
-        ipl_map = {}
-        for fname in files:
-            inFile = open(fname)
-            
-            currentId = None
-            for line in inFile:
-                if line.startswith('>'):
-                    currentId = line.rstrip().strip('>').strip()
-                    sampleData[currentId] = array.array("f")
-                    if len(ipl_map) > 0:
-                        for a in ipl_map:
-                            sampleData[currentId].append(0.0)
-                    continue
-
-                if currentId is None:
-                    continue
-
-                data = line.rstrip().split('\t')
-                name = data[0]
-                if len(name.split("__")) > 1:
-                    continue
-
-                try:
-                    val = float(data[1])
-                except ValueError:
-                    val = float('nan')
-                    
-                if name not in ipl_map:
-                    ipl_map[name] = len(ipl_map)
-                    sampleData[currentId].append(val)
-                else:
-                    sampleData[currentId][ipl_map[name]] = val
-            inFile.close()
-            #addData(f, sampleData)
-
-        if len(sampleData) > 0:
-            outname = os.path.join(outdirectory, "merged_" + g + ".out")
-    
-            print "merging", len(files), "files into", outname
-            outputData(outname, sampleData, ipl_map)
-    
-            outnameTranspose = os.path.join(outdirectory, "merged_transpose_" + g + ".out")
-            outputDataTranspose(outnameTranspose, sampleData, ipl_map)
-
-def main(suffix, indirectory, outdirectory):
+def groupMemory(files):
+    """bytes a merge of files is expected to take, from their sizes"""
+    return memoryFactor * sum([os.path.getsize(f) for f in files]) + chunkSize
+
+def storeBlock(storeDir, outnameTranspose, sampleRow, entities, block):
+    """adds the transposed table of a group to a mergeStore.py store"""
+    sampleNames = sortedSamples(sampleRow)
+    rows = [sampleRow[sample] for sample in sampleNames]
+    if numpy is not None:
+        values = block[rows].T
+    else:
+        values = [array.array("f", column) for column in zip(*[block[r] for r in rows])]
+    ## the pid merge_merged.py takes from the name of the transposed table
+    pid = outnameTranspose[:-4].split("_").pop()
+    mergeStore.writeBlock(storeDir, pid, entities, sampleNames, values)
+
+def mergeGroup(outdirectory, g, files, transposeOnly = False, storeDir = None):
+    """
+    merges the files of group g, returns the merged file (the transposed
+    one with transposeOnly) or None; with storeDir the group is also added
+    to that store
+    """
+    (sampleRow, entities, block) = readGroup(files)
+    if len(sampleRow) == 0:
+        return None
+
+    outname = os.path.join(outdirectory, "merged_" + g + ".out")
+    outnameTranspose = os.path.join(outdirectory, "merged_transpose_" + g + ".out")
+    if storeDir is not None:
+        storeBlock(storeDir, outnameTranspose, sampleRow, entities, block)
+    if transposeOnly:
+        outputData(None, outnameTranspose, sampleRow, entities, block)
+        return outnameTranspose
+    outputData(outname, outnameTranspose, sampleRow, entities, block)
+    return outname
+
+def mergeTask(args):
+    """mergeGroup in a pool process, returns (group, merged file, error)"""
+    (outdirectory, g, files, transposeOnly, storeDir) = args
+    try:
+        return (g, mergeGroup(outdirectory, g, files, transposeOnly, storeDir), None)
+    except Exception, err:
+        return (g, None, "%s: %s" % (g, err))
+
+def initWorker():
+    ## interrupts are handled by the parent, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def mergeGroups(outdirectory, groups, workers = 1, memory = None,
+                transposeOnly = False, storeDir = None):
+    """
+    Merges each group of files into merged_<group>.out and
+    merged_transpose_<group>.out.  The files of a group are read in sorted
+    order and the groups largest first; with workers > 1 they are merged by
+    a pool of processes, running no more groups at a time than fit in
+    memory (MB) by groupMemory.  With transposeOnly only the transposed
+    files are written, with storeDir the groups are also added to that
+    mergeStore.py store.
+    """
+    order = sorted(groups.keys(), key = lambda g: (-groupMemory(groups[g]), g))
+    tasks = [(outdirectory, g, sorted(groups[g]), transposeOnly, storeDir) for g in order]
+
+    if workers <= 1:
+        for (outdirectory, g, files, transposeOnly, storeDir) in tasks:
+            outname = mergeGroup(outdirectory, g, files, transposeOnly, storeDir)
+            if outname is not None:
+                print "merging", len(files), "files into", outname
+        return
+
+    budget = None
+    if memory is not None:
+        budget = memory * (1 << 20)
+    finished = Queue.Queue()
+    pool = multiprocessing.Pool(workers, initWorker)
+    try:
+        running = {}
+        failed = []
+        while len(tasks) > 0 or len(running) > 0:
+            ## a group that is over the budget on its own runs by itself
+            while len(tasks) > 0 and len(running) < workers and \
+                    (len(running) == 0 or budget is None or
+                     sum(running.values()) + groupMemory(tasks[0][2]) <= budget):
+                task = tasks.pop(0)
+                running[task[1]] = groupMemory(task[2])
+                pool.apply_async(mergeTask, (task,), callback = finished.put)
+            ## waiting without a timeout would not let an interrupt through
+            try:
+                (g, outname, error) = finished.get(True, 60)
+            except Queue.Empty:
+                continue
+            del running[g]
+            if error is not None:
+                failed.append(error)
+            elif outname is not None:
+                print "merging", len(groups[g]), "files into", outname
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    if len(failed) > 0:
+        for error in failed:
+            sys.stderr.write("merge failed: %s\n" % error)
+        sys.exit(1)
+
+def main(suffix, indirectory, outdirectory, workers = 1, memory = None,
+         transposeOnly = False, storeDir = None):
     allfiles = getFilesMatching(indirectory, [suffix])
     print "found ", len(allfiles), " files total"
     
     groups = groupFilesById(allfiles)
     print "grouped files into ", len(groups), " groups"
 
-    mergeGroups(outdirectory, groups)
+    if storeDir is not None and not os.path.exists(storeDir):
+        os.makedirs(storeDir)
+    mergeGroups(outdirectory, groups, workers, memory, transposeOnly, storeDir)
     
 
 def usage():
-    print "python mergeSwarmFiles.py [suffix] indirectory outdirectory"
+    print "python mergeSwarmFiles.py [options] [suffix] indirectory outdirectory"
+    print ""
+    print "Options:"
+    print "  -j int    groups merged at the same time (default: 1)"
+    print "  -m int    memory the merges may take in MB, estimated from the"
+    print "            sizes of their files (default: physical memory)"
+    print "  -t        write only the merged_transpose_ files"
+    print "  -s dir    also add the merged groups to the mergeStore.py store dir"
     sys.exit(0)
     
 if __name__ == "__main__":
-    if len(sys.argv) != 3 and len(sys.argv) != 4:
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:m:ts:")
+    except getopt.GetoptError, err:
+        print str(err)
         usage()
-        
-    if len(sys.argv) == 3:
+    if len(args) != 2 and len(args) != 3:
+        usage()
+
+    workers = 1
+    memory = physicalMemory()
+    transposeOnly = False
+    storeDir = None
+    for o, a in opts:
+        if o == "-j":
+            workers = int(a)
+        elif o == "-m":
+            memory = int(a)
+        elif o == "-t":
+            transposeOnly = True
+        elif o == "-s":
+            storeDir = a
+
+    if len(args) == 2:
         suffix = "*.fa"
-        indirectory = sys.argv[1]
-        outdirectory = sys.argv[2]
+        indirectory = args[0]
+        outdirectory = args[1]
 
-    if len(sys.argv) == 4:
-        suffix = "*" + sys.argv[1]
-        indirectory = sys.argv[2]
-        outdirectory = sys.argv[3]
+    if len(args) == 3:
+        suffix = "*" + args[0]
+        indirectory = args[1]
+        outdirectory = args[2]
 
-    main(suffix, indirectory, outdirectory)
-        
+    main(suffix, indirectory, outdirectory, workers, memory, transposeOnly, storeDir)
@@ -3,13 +3,18 @@
 import os
 import sys
 import fnmatch
+import operator
 #from hgSQL import hgSQL
 
-resultMatrix = {} # first key is entity, then sample
+resultMatrix = {} # pid_entity to its (table, row); the row of the last file wins
 allMatrix = {}
 
+tables = [] # (sample headers, samples, data rows) of each file read
+
 sampleList = []
 allsampleList = []
+sampleIndex = {} # sample to its column in sampleList
+allsampleIndex = {}
 
 def usage():
 	print "Usage: "+sys.argv[0]+" db merged_dir"
@@ -26,29 +31,65 @@ def getFilesMatching(baseDir, patterns):
 					list.append(ptr)
 	return list
 
+def addSample(sample, samples, index):
+	if sample not in index:
+		index[sample] = len(samples)
+		samples.append(sample)
+
 def addFileToResult(file):
 	pid = file[:-4].split("_").pop()
 	fh = open(file,"r")
 	header = fh.readline().strip("\n").split("\t")
 	sampleOrder = header[1:]
 	#print sampleOrder
-	for sample in sampleOrder:
-		if sample.startswith("na_") == False and sample.split(" ").pop(0) not in sampleList:
-			sampleList.append(sample.split(" ").pop(0))
-		if sample.split(" ").pop(0) not in allsampleList:
-			allsampleList.append(sample.split(" ").pop(0))
+	sampleNames = [sample.split(" ").pop(0) for sample in sampleOrder]
+	for sample, name in zip(sampleOrder, sampleNames):
+		if sample.startswith("na_") == False:
+			addSample(name, sampleList, sampleIndex)
+		addSample(name, allsampleList, allsampleIndex)
+	table = len(tables)
+	rows = []
+	tables.append((sampleOrder, sampleNames, rows))
 	for line in fh:
 		dataA = line.strip("\n").split("\t")
 		entity = dataA.pop(0)
-		resultMatrix[pid+"_"+entity] = {}
-		allMatrix[pid+"_"+entity] = {}
-		for i in range(len(dataA)):
-			sample = sampleOrder[i] ## sng ##
-			if sample.startswith("na_") == False:
-				resultMatrix[pid+"_"+entity][sampleOrder[i].split(" ").pop(0)] = dataA[i]
-			allMatrix[pid+"_"+entity][sampleOrder[i].split(" ").pop(0)] = dataA[i]
+		if len(dataA) < len(sampleOrder):
+			dataA += [""] * (len(sampleOrder) - len(dataA))
+		resultMatrix[pid+"_"+entity] = (table, len(rows))
+		allMatrix[pid+"_"+entity] = (table, len(rows))
+		rows.append(dataA)
 	fh.close()
 
+def columnRemap(table, index, includeNull):
+	"""
+	for each column of index, the column of table holding its sample, or
+	one past the last column if it has none (later columns of a sample win)
+	"""
+	(sampleOrder, sampleNames, rows) = table
+	remap = [len(sampleOrder)] * len(index)
+	for i in range(len(sampleOrder)):
+		if includeNull or sampleOrder[i].startswith("na_") == False:
+			remap[index[sampleNames[i]]] = i
+	return remap
+
+def remapRow(row, remap):
+	"""the values of row in the columns of remap, "" where it has none"""
+	if len(remap) == 0:
+		return []
+	if len(remap) == 1:
+		return [(row + [""])[remap[0]]]
+	return operator.itemgetter(*remap)(row + [""])
+
+def writeMatrix(filename, matrix, samples, index, includeNull):
+	remaps = [columnRemap(table, index, includeNull) for table in tables]
+	outFile = open(filename,"w")
+	outFile.write("pid_entity\t")
+	outFile.write("\t".join(samples)+"\n")
+	for entity in matrix:
+		(table, row) = matrix[entity]
+		outFile.write(entity + "\t" + "\t".join(remapRow(tables[table][2][row], remaps[table])) + "\n")
+	outFile.close()
+
 def main(db,directory):
 	files = getFilesMatching(directory, ["*_transpose_*"])
 
@@ -86,35 +127,8 @@ def main(db,directory):
 	#connection.close()
 	#print "done."
 	print "Printing Results..."
-	resultFile = open("merge_merged.tab","w")
-	resultFile.write("pid_entity\t")
-	resultFile.write("\t".join(sampleList)+"\n")
-	for entity in resultMatrix:
-		resultFile.write(entity)
-		for sample in sampleList:
-			resultFile.write("\t")
-			#print sample
-			#print resultMatrix[entity]
-			#sys.exit(0)
-			if sample in resultMatrix[entity]:
-				resultFile.write(resultMatrix[entity][sample])
-		resultFile.write("\n")
-	resultFile.close()
-	
-	allFile = open("merge_merged.all.tab","w")
-	allFile.write("pid_entity\t")
-	allFile.write("\t".join(allsampleList)+"\n")
-	for entity in allMatrix:
-		allFile.write(entity)
-		for sample in allsampleList:
-			allFile.write("\t")
-			#print sample
-			#print allMatrix[entity]
-			#sys.exit(0)
-			if sample in allMatrix[entity]:
-				allFile.write(allMatrix[entity][sample])
-		allFile.write("\n")
-	allFile.close()
+	writeMatrix("merge_merged.tab", resultMatrix, sampleList, sampleIndex, False)
+	writeMatrix("merge_merged.all.tab", allMatrix, allsampleList, allsampleIndex, True)
 
 if __name__ == "__main__":
 	if len(sys.argv) != 3:
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+"""paradigmJobs.py: the steps of a paradigm run, shared by the runners
+
+jtParadigm.py runs these steps as jobTree targets and localParadigm.py
+runs them with a local process pool; neither the steps nor this module
+need jobTree.  All of them work in the current directory, as set up by
+prepareParadigm.py.
+"""
+import sys
+import os
+import os.path
+import re
+import glob
+import shutil
+import tempfile
+import time
+import hashlib
+import matrixCache
+import paramCache
+import collectParams
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+
+mergeSwarm = os.path.join(basedir, "mergeSwarmFiles.py")
+mergeMerge = os.path.join(basedir, "merge_merged.py")
+mergeStore = os.path.join(basedir, "mergeStore.py")
+filterFeatures = os.path.join(basedir, "filterFeatures.py")
+pyJoin = os.path.join(basedir, "join.py")
+createNulls = os.path.join(basedir, "createNullFiles.py")
+costModel = os.path.join(basedir, "costModel.py")
+
+## prefix of jobs.list lines whose null evidence is generated by the job,
+## written by prepareParadigm.py -l as
+##   lazyNull:<null spec>:<batch>:<k>,<n> <paradigm command>
+## where the paradigm command reads its evidence from $NULLDIR
+lazyNullTag = "lazyNull:"
+
+## joins the paradigm commands of short pathways that prepareParadigm.py
+## packed into one job; they run one after the other, each on its own
+jobSeparator = " && "
+
+## the stderr of each paradigm command is appended to a log file here,
+## named after the command's output file
+logDir = "jobLogs"
+
+## a job is done once a file named after the sha1 of its command line,
+## its output path and the contents of its inputs is here, and its output
+## is complete; a resumed run only runs the jobs that are not done
+doneDir = "jobsDone"
+
+def system(cmd):
+    """runs cmd through the shell, raising RuntimeError if it fails"""
+    status = os.system(cmd)
+    if status != 0:
+        raise RuntimeError("command failed with exit status %i: %s" % (status, cmd))
+
+def readJobList(filename):
+    """
+    The commands of a job list, longest first by the "# estimate=<s>s"
+    prepareParadigm.py ends each line with; lines without one go last.
+    The estimate comment is removed from the commands.
+    """
+    jobs = []
+    jfile = open(filename, "r")
+    for i, job in enumerate(jfile):
+        if job.isspace():
+            continue
+        m = re.search("\s*#\s*estimate=([0-9.e+-]+)s\s*$", job)
+        if m:
+            cost = float(m.group(1))
+            job = job[:m.start()]
+        else:
+            cost = -1.0
+        jobs.append((-cost, i, job.rstrip("\n")))
+    jfile.close()
+    jobs.sort()
+    return [job for (cost, i, job) in jobs]
+
+def jobParts(cmd):
+    """the paradigm commands of a job line, several if prepareParadigm packed it"""
+    return cmd.split(jobSeparator)
+
+def jobOutput(cmd):
+    """the output file of a paradigm command, None if it has none"""
+    m = re.search("\s-[eo]\s*(\S+)", cmd)
+    if m is None:
+        return None
+    return m.group(1)
+
+def jobLog(cmd):
+    output = jobOutput(cmd)
+    if output is None:
+        return None
+    return os.path.join(logDir, os.path.basename(output) + ".log")
+
+def runJobPart(cmd, logFile = None):
+    if logFile is not None:
+        redirect = " 2>> %s" % logFile
+    else:
+        redirect = ""
+    if cmd.startswith(lazyNullTag):
+        runLazyNull(cmd, redirect)
+    else:
+        system(cmd + redirect)
+
+def recordTime(cmd, seconds):
+    """appends the wall time of a command to jobTimes.tab for the cost model"""
+    output = jobOutput(cmd)
+    if output is None:
+        return
+    f = open("jobTimes.tab", "a")
+    f.write("%s\t%.2f\n" % (output, seconds))
+    f.close()
+
+def runLazyNull(cmd, redirect = ""):
+    """
+    Generates the bucket of null samples of a lazyNull command into local
+    scratch and runs its paradigm command on them
+    """
+    (spec, cmd) = cmd.split(None, 1)
+    (tag, specFile, batch, part) = spec.split(":")
+    scratch = tempfile.mkdtemp(prefix="paradigmNulls.")
+    try:
+        system("%s %s -q -S %s -k %s,%s -p %s/na_batch_%s_ > /dev/null%s"
+               % (sys.executable, createNulls, specFile, batch, part,
+                  scratch, batch, redirect))
+        ## the shell would expand $NULLDIR before a NULLDIR=... prefix
+        ## took effect, so the scratch directory goes into the command
+        cmd = cmd.replace("$NULLDIR", scratch)
+        if not glob.glob("%s/na_batch_%s_*" % (scratch, batch)):
+            raise RuntimeError("no null samples generated for %s" % (cmd))
+        system(cmd + redirect)
+    finally:
+        shutil.rmtree(scratch, True)
+
+def jobOption(cmd, option):
+    m = re.search("\s-%s\s*(\S+)" % option, cmd)
+    if m is None:
+        return None
+    return m.group(1)
+
+def configInputs(configFile):
+    """the param file and the evidence suffixes named in a paradigm config"""
+    f = open(configFile, "r")
+    config = f.read()
+    f.close()
+    params = re.findall("param_file=([^,\]]+)", config)
+    suffixes = re.findall("suffix=([^,\]]+)", config)
+    return (params, suffixes)
+
+def jobInputs(cmd):
+    """the files a paradigm command reads"""
+    inputs = []
+    if cmd.startswith(lazyNullTag):
+        ## the evidence is generated from the null spec
+        (spec, cmd) = cmd.split(None, 1)
+        inputs.append(spec.split(":")[1])
+    pathway = jobOption(cmd, "p")
+    if pathway is not None:
+        inputs.append(pathway)
+    configFile = jobOption(cmd, "c")
+    if configFile is not None and os.path.exists(configFile):
+        inputs.append(configFile)
+        (params, suffixes) = configInputs(configFile)
+        inputs += params
+        dataPrefix = jobOption(cmd, "b")
+        if dataPrefix is not None and "$" not in dataPrefix:
+            inputs += [dataPrefix + suffix for suffix in suffixes]
+    return inputs
+
+## digests of input files by (path, size, mtime), so that the evidence
+## shared by all jobs is read once
+digests = {}
+
+def inputDigest(filename):
+    if not os.path.exists(filename):
+        return "missing"
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in digests:
+        digests[key] = matrixCache.fileDigest(path)
+    return digests[key]
+
+def jobKey(cmd):
+    """
+    sha1 of a paradigm command, the real path of its output and the
+    contents of its inputs; None if the command has no output
+    """
+    output = jobOutput(cmd)
+    if output is None:
+        return None
+    digest = hashlib.sha1()
+    digest.update(cmd.strip() + "\n")
+    digest.update(os.path.realpath(output) + "\n")
+    for filename in jobInputs(cmd):
+        digest.update("%s\t%s\n" % (filename, inputDigest(filename)))
+    return digest.hexdigest()
+
+## samples of each job output, from the jobFeatures.tab of prepareParadigm.py
+jobSamples = None
+
+def expectedSamples(output):
+    global jobSamples
+    if jobSamples is None:
+        jobSamples = {}
+        if os.path.exists("jobFeatures.tab"):
+            f = open("jobFeatures.tab", "r")
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                pline = line.rstrip("\r\n").split("\t")
+                jobSamples[pline[0]] = int(pline[2])
+            f.close()
+    return jobSamples.get(output)
+
+def outputRecords(output):
+    """
+    The number of records of a paradigm output that is written through,
+    starting with a record and ending in a newline; learned parameters
+    count as one record once they have their logZ header.  None if the
+    output is missing or cut short
+    """
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return None
+    f = open(output, "r")
+    first = f.readline()
+    if not first.startswith(">"):
+        f.close()
+        return None
+    if output.endswith("_learned_parameters.fa"):
+        f.seek(-1, 2)
+        complete = "logZ=" in first and f.read(1) == "\n"
+        f.close()
+        if complete:
+            return 1
+        return None
+    records = 1
+    last = first
+    for line in f:
+        if line.startswith(">"):
+            records += 1
+        last = line
+    f.close()
+    if not last.endswith("\n"):
+        return None
+    return records
+
+def outputComplete(output, records = None):
+    """
+    Whether a paradigm output looks complete: learned parameters have
+    their logZ header, and inference outputs have the given number of
+    records, by default a record for every sample of jobFeatures.tab
+    """
+    found = outputRecords(output)
+    if found is None:
+        return False
+    if output.endswith("_learned_parameters.fa"):
+        return True
+    if records is None:
+        records = expectedSamples(output)
+    return records is None or found == records
+
+def doneRecords(key):
+    """
+    The number of output records markDone() saw for a done job, None if
+    the job is not done; -1 for a done file that has no count
+    """
+    doneFile = os.path.join(doneDir, key)
+    if not os.path.exists(doneFile):
+        return None
+    f = open(doneFile, "r")
+    lines = f.read().splitlines()
+    f.close()
+    for line in lines[1:]:
+        if line.startswith("records="):
+            return int(line[len("records="):])
+    return -1
+
+def jobDone(cmd, key):
+    """
+    Whether a command is done: its done file is there and its output still
+    has the records it had when the command succeeded, or for done files
+    without a count, a record for every sample of jobFeatures.tab
+    """
+    if key is None:
+        return False
+    records = doneRecords(key)
+    if records is None:
+        return False
+    if records < 0:
+        records = None
+    return outputComplete(jobOutput(cmd), records)
+
+def markDone(cmd, key):
+    """
+    Marks a command that succeeded as done, with the number of records of
+    its output; paradigm may split the samples of a job differently than
+    prepareParadigm.py counted them, so this is what a resume checks.  A
+    command whose output is cut short is not marked
+    """
+    if key is None:
+        return
+    records = outputRecords(jobOutput(cmd))
+    if records is None:
+        return
+    f = open(os.path.join(doneDir, key), "w")
+    f.write("%s\n" % cmd)
+    f.write("records=%i\n" % records)
+    f.close()
+
+def pendingJobs(filename):
+    """
+    The jobs of a job list that are not done, as (job, keys) with a key for
+    each command of the job, and the number of jobs that are done
+    """
+    pending = []
+    done = 0
+    for job in readJobList(filename):
+        parts = jobParts(job)
+        keys = [jobKey(part) for part in parts]
+        if all([jobDone(part, key) for part, key in zip(parts, keys)]):
+            done += 1
+        else:
+            pending.append((job, keys))
+    return (pending, done)
+
+def runJob(job, retries = 0, backoff = 10.0, keys = None):
+    """
+    Runs the commands of a job line one after the other, recording their
+    times and appending their stderr to their logs.  A failed command is
+    tried again up to retries times, after backoff seconds and then twice
+    as long each time; the other commands of the job still run when one
+    fails for good, and RuntimeError is raised once they are through.
+    Given the keys of pendingJobs(), commands that are done are skipped
+    and the others are marked done once they succeed.
+    """
+    parts = jobParts(job)
+    if keys is None:
+        keys = [None] * len(parts)
+    failed = []
+    for part, key in zip(parts, keys):
+        if jobDone(part, key):
+            continue
+        logFile = jobLog(part)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                runJobPart(part, logFile)
+                error = None
+                break
+            except RuntimeError, err:
+                error = err
+                if attempt >= retries:
+                    break
+                wait = backoff * 2**attempt
+                attempt += 1
+                if logFile is not None:
+                    f = open(logFile, "a")
+                    f.write("## %s\n## retry %i of %i in %gs\n" % (err, attempt, retries, wait))
+                    f.close()
+                time.sleep(wait)
+        if error is not None:
+            failed.append(str(error))
+            continue
+        recordTime(part, time.time() - start)
+        markDone(part, key)
+    if len(failed) > 0:
+        raise RuntimeError("; ".join(failed))
+
+def startExpectation(iteration):
+    """points params.txt and outputFilesEM at the given iteration"""
+    system("rm -f params.txt")
+    system("ln -s params%i.txt params.txt" % iteration)
+
+    system("mkdir -p outputFilesEM%i" % iteration)
+    system("rm -f outputFilesEM")
+    system("ln -s outputFilesEM%i outputFilesEM" % iteration)
+    system("mkdir -p %s %s" % (logDir, doneDir))
+
+def collectParameters(iteration):
+    """collects the expectations of an iteration into the next parameters"""
+    expectationMask = None
+    if os.path.exists("mask.expectations"):
+        expectationMask = "mask.expectations"
+    paramMask = None
+    if os.path.exists("mask.params"):
+        paramMask = "mask.params"
+    collectParams.collectParameters("params%i.txt" % (iteration + 1),
+                                    sorted(glob.glob("outputFilesEM/*learn*")),
+                                    expectationMask, paramMask)
+
+def cacheParameters(iteration):
+    """adds the converged parameters to the cache prepareParadigm.py -w set up"""
+    if os.path.exists(paramCache.runFile):
+        paramCache.storeRun("params%i.txt" % iteration)
+
+def startFinalRun(iteration):
+    system("rm -f params.txt")
+    system("ln -s params%i.txt params.txt" % iteration)
+    system("mkdir -p outputFiles")
+    system("mkdir -p %s %s" % (logDir, doneDir))
+
+def mergeOutputs(workers = 1, memory = None):
+    """
+    merges outputFiles into the merge_merged tables, the pathways with
+    workers processes within memory MB
+    """
+    system("mkdir -p mergeFiles")
+    system("rm -rf mergeStore")
+    ## only the transposed tables and the store are used
+    options = "-t -s mergeStore -j %i" % workers
+    if memory is not None:
+        options += " -m %i" % memory
+    system("%s %s %s outputFiles mergeFiles" % (sys.executable, mergeSwarm, options))
+    mergeFiles = glob.glob("mergeFiles/*transpose*")
+    if len(mergeFiles) == 1: # a global pathway
+        system("cat %s | sed 's/ loglikelihood=-[0-9.]*//g' > merge_merged_unfiltered.all.tab" % (mergeFiles[0]))
+        o = open("merge_merged_unfiltered.tab", "w")
+        f = open("merge_merged_unfiltered.all.tab", "r")
+        sampleNames = f.readline().rstrip().split("\t")[1:]
+        includeCols = []
+        for i, sample in enumerate(sampleNames):
+            if sample.startswith("na_") or sample.startswith("nw_"):
+                continue
+            includeCols.append(i)
+        data = [sampleNames[i] for i in includeCols]
+        o.write("%s\t%s\n" % ("id", "\t".join(data)))
+        for line in f:
+            pline = line.rstrip().split("\t")
+            feature = pline[0]
+            data = [pline[i+1] for i in includeCols]
+            o.write("%s\t%s\n" % (feature, "\t".join(data)))
+        f.close()
+        o.close()
+        system("%s %s -n merge_merged_unfiltered.tab 1,0.5 > merge_merged.tab" % (sys.executable, filterFeatures))
+        system("cut -f1 merge_merged.tab > filter.include")
+        system("%s %s -h filter.include merge_merged_unfiltered.all.tab > merge_merged.all.tab" % (sys.executable, pyJoin))
+        system("rm -f filter.include")
+    else:
+        system("%s %s -q mergeStore" % (sys.executable, mergeStore))
+    if os.path.exists("runtimeHistory.txt"):
+        f = open("runtimeHistory.txt", "r")
+        history = f.readline().rstrip("\n")
+        f.close()
+        system("%s %s -q -r . %s" % (sys.executable, costModel, history))
+
+def commandAvailable(executable):
+    return 0 == os.system("which %s > /dev/null 2> /dev/null" % executable)
+
+def checkRunDirectory():
+    """asserts the current directory was set up by prepareParadigm.py"""
+    assert os.path.exists("jobs.list")
+    assert os.path.exists("jobsEM.list")
+    assert os.path.exists("config.txt")
+    assert os.path.exists("configEM.txt")
+    assert os.path.exists("params0.txt")
+
+    assert commandAvailable(mergeSwarm)
+    assert commandAvailable(mergeMerge)
+    assert commandAvailable(mergeStore)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""paramCache.py: cache of converged paradigm parameters
+
+Keeps the parameters EM converged to, one entry for each evidence
+attachment of a run, keyed by the dogma (the config tops and the files
+of the dogma directory), the pathway library, the attachment and its discretization bounds.  A new cohort on
+the same setup then starts EM from the nearest entry instead of from the
+initial parameters of prepareParadigm.py (see its -w option), which cuts
+the iterations EM needs.
+
+A cache directory holds
+  index.tab   one line per entry: dogma and pathway library digests,
+              attachment, bounds, logZ, time stored and parameter file
+  params/     the parameters of one attachment an entry points to (the
+              lines under its header in a params.txt), named after their
+              sha1
+
+prepareParadigm.py -w writes the keys of its run to paramCache.json, and
+the runners store the converged parameters once EM has finished.
+
+Usage:
+  paramCache.py [options] cacheDir
+
+Options:
+  -s file   store the parameter file of the run in the current directory
+  -q        run quietly
+
+Without -s the entries of the cache are listed.
+"""
+import os, sys, glob, getopt, re, json, time, hashlib
+import matrixCache
+
+verbose = True
+
+runFile = "paramCache.json"
+indexFile = "index.tab"
+indexHeader = "# dogma\tpathways\tattachment\tbounds\tlogZ\tstored\tparams\n"
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def textDigest(text):
+    return hashlib.sha1(text).hexdigest()
+
+def libraryDigest(pathFiles):
+    """sha1 of the names and contents of the files of a pathway library"""
+    digest = hashlib.sha1()
+    for p in sorted(pathFiles, key = os.path.basename):
+        digest.update("%s\t%s\n" % (os.path.basename(p), matrixCache.fileDigest(p)))
+    return digest.hexdigest()
+
+def dogmaDigest(configText, dogmaDir = None):
+    """
+    sha1 of the config tops of a run and the names and contents of the
+    files of its dogma directory (the *.dogma, *.imap and mask.* files
+    copied into the run); without a directory, textDigest(configText)
+    """
+    digest = hashlib.sha1()
+    digest.update(configText)
+    if dogmaDir:
+        for p in sorted(glob.glob(os.path.join(dogmaDir, "*"))):
+            if os.path.isfile(p):
+                digest.update("%s\t%s\n" % (os.path.basename(p), matrixCache.fileDigest(p)))
+    return digest.hexdigest()
+
+def numBins(bounds):
+    return len(bounds.split(";")) + 1
+
+def readParams(paramFile, suffixes = {}):
+    """
+    The parameter lines of each attachment of a parameter file; headers
+    naming the evidence file (child='<suffix>') rather than the attachment
+    are mapped to it by suffixes, a suffix to attachment map
+    """
+    storedParams = {}
+    f = open(paramFile, "r")
+    f.readline()
+    for line in f:
+        if line.isspace():
+            continue
+        line = line.rstrip("\n\r")
+        if line.startswith(">"):
+            m = re.search("child='([^']*)'", line)
+            if m and m.group(1) in suffixes:
+                attachment = suffixes[m.group(1)]
+            else:
+                attachment = re.split("=", line)[-1]
+            storedParams[attachment] = ""
+        else:
+            storedParams[attachment] += "%s\n" % (line)
+    f.close()
+    return storedParams
+
+def readLogZ(paramFile):
+    f = open(paramFile, "r")
+    topline = f.readline()
+    f.close()
+    m = re.search("logZ=([0-9.e+-]*)", topline)
+    if m is None:
+        return float("nan")
+    return float(m.group(1))
+
+def readIndex(cacheDir):
+    entries = []
+    indexPath = os.path.join(cacheDir, indexFile)
+    if not os.path.exists(indexPath):
+        return entries
+    f = open(indexPath, "r")
+    for line in f:
+        if line.startswith("#") or line.isspace():
+            continue
+        pline = line.rstrip("\r\n").split("\t")
+        entries.append({"dogma" : pline[0], "pathways" : pline[1],
+                        "attachment" : pline[2], "bounds" : pline[3],
+                        "logZ" : float(pline[4]), "stored" : float(pline[5]),
+                        "params" : os.path.join(cacheDir, pline[6])})
+    f.close()
+    return entries
+
+def nearest(entries, dogma, pathways, attachment, bounds):
+    """
+    The entry for an attachment closest to the given keys: entries must
+    have the same attachment and number of bins; of those, the ones
+    sharing the dogma, then the pathway library, then the exact bounds
+    are preferred, and the most recent of equals.  None if there is none;
+    an entry of another dogma or pathway library is logged.
+    """
+    best = None
+    bestScore = None
+    for e in entries:
+        if e["attachment"] != attachment or numBins(e["bounds"]) != numBins(bounds):
+            continue
+        score = (e["dogma"] == dogma, e["pathways"] == pathways,
+                 e["bounds"] == bounds, e["stored"])
+        if bestScore is None or score > bestScore:
+            best = e
+            bestScore = score
+    if best is not None and best["dogma"] != dogma:
+        log("    %s parameters come from another dogma (%s)\n"
+            % (attachment, best["dogma"][:8]))
+    if best is not None and best["pathways"] != pathways:
+        log("    %s parameters come from another pathway library (%s)\n"
+            % (attachment, best["pathways"][:8]))
+    return best
+
+def readEntry(entry):
+    """the parameter lines of an entry"""
+    f = open(entry["params"], "r")
+    params = f.read()
+    f.close()
+    return params
+
+def store(cacheDir, logZ, dogma, pathways, evidence, storedParams):
+    """
+    Adds parameters to the cache, an entry for each (attachment, bounds)
+    of evidence that storedParams (an attachment to parameter lines map,
+    as read by readParams) has parameters for.  Returns the number of
+    entries added.
+    """
+    paramDir = os.path.join(cacheDir, "params")
+    if not os.path.exists(paramDir):
+        os.makedirs(paramDir)
+    stored = set([(e["dogma"], e["pathways"], e["attachment"], e["bounds"], e["params"])
+                  for e in readIndex(cacheDir)])
+    indexPath = os.path.join(cacheDir, indexFile)
+    writeHeader = not os.path.exists(indexPath)
+    f = open(indexPath, "a")
+    if writeHeader:
+        f.write(indexHeader)
+    added = 0
+    for (attachment, bounds) in evidence:
+        if attachment not in storedParams:
+            continue
+        name = os.path.join("params", textDigest(storedParams[attachment]) + ".txt")
+        if (dogma, pathways, attachment, bounds, os.path.join(cacheDir, name)) in stored:
+            continue
+        if not os.path.exists(os.path.join(cacheDir, name)):
+            pfile = open(os.path.join(cacheDir, name), "w")
+            pfile.write(storedParams[attachment])
+            pfile.close()
+        f.write("%s\t%s\t%s\t%s\t%g\t%.0f\t%s\n" % (dogma, pathways, attachment,
+                                                  bounds, logZ, time.time(), name))
+        added += 1
+    f.close()
+    return added
+
+def writeRun(cacheDir, dogma, pathways, evidence):
+    """
+    Records the cache and keys of the run in the current directory;
+    evidence is a list of (attachment, bounds, suffix)
+    """
+    f = open(runFile, "w")
+    json.dump({"cache" : os.path.abspath(cacheDir), "dogma" : dogma,
+               "pathways" : pathways, "evidence" : evidence}, f)
+    f.close()
+
+def storeRun(paramFile, cacheDir = None):
+    """
+    Stores a parameter file of the run in the current directory, in the
+    cache it was prepared with unless cacheDir is given
+    """
+    f = open(runFile, "r")
+    run = json.load(f)
+    f.close()
+    if cacheDir is None:
+        cacheDir = run["cache"]
+    evidence = [(attachment, bounds) for (attachment, bounds, suffix) in run["evidence"]]
+    suffixes = dict([(suffix, attachment) for (attachment, bounds, suffix) in run["evidence"]])
+    return store(cacheDir, readLogZ(paramFile), run["dogma"], run["pathways"],
+                 evidence, readParams(paramFile, suffixes))
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "s:q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        print "incorrect number of arguments"
+        usage(1)
+    cacheDir = args[0]
+    paramFile = None
+    global verbose
+    for o, a in opts:
+        if o == "-s":
+            paramFile = a
+        elif o == "-q":
+            verbose = False
+    if paramFile is not None:
+        added = storeRun(paramFile, cacheDir)
+        log("stored %i entries of %s in %s\n" % (added, paramFile, cacheDir))
+        return
+    for e in readIndex(cacheDir):
+        print "%s\t%s\t%s\t%s\t%g\t%s\t%s" % (e["dogma"][:8], e["pathways"][:8],
+            e["attachment"], e["bounds"], e["logZ"],
+            time.strftime("%Y-%m-%d", time.localtime(e["stored"])), e["params"])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,13 +4,34 @@
 Creates in the current directory:
   clusterFiles/  the specified database tables or tab files
                  will be rank transformed and also pathway 
-                 files are placed in this directory
+                 files are placed in this directory, each evidence
+                 file with a binary cache (see matrixCache.py)
 
   configEM.txt  the configuration file for EM runs
-  jobsEM.list   the list of parasol jobs for EM
+  jobsEM.list   the jobs for EM, longest predicted first, short pathways
+                packed together into jobs of about the target length
 
   config.txt     the configuration for the final run
-  jobs.list      the list of parasol jobs fro the final run
+  jobs.list      the jobs for the final run, longest predicted first and
+                 packed like jobsEM.list
+
+  nullSeed.txt   the master seed the null batches were drawn with
+  nullSpec.json  with -l, what jobs need to generate their null samples
+  jobFeatures.tab
+                 the pathway, samples, evidence count and pathway size
+                 of every job, for the runtime model (see costModel.py)
+  paramCache.json
+                 with -w, the cache and the keys of this run's parameters
+
+Each line of a job list is a shell command line ending in a
+"# estimate=<seconds>s" comment, the predicted length of the job.  The
+lists are meant for jtParadigm.py and localParadigm.py, which read the
+estimates; a batch system that runs lines as they are, such as parasol,
+would pass the comment to paradigm as arguments.
+
+The commands of a packed job are joined with " && ", so a shell running
+the line stops at the first command that fails; jtParadigm.py and
+localParadigm.py run and log every command of the job on its own.
 
 Usage:
   prepareParadigm.py [options] attach1 evid1 [attach2 evid2 ...]
@@ -22,6 +43,11 @@ Evidence is specified as:
     http:<url>               read file from URL
     http:<url>               read file from URL, no quantile transform
     file:<tabfile_name>      where <tabfile_name> is the path to a file
+    largeFile:<tabfile>      like file:, but rank transformed out-of-core
+                             for matrices that do not fit in memory
+    rankRowFile:<tabfile>    like file:, but each row (gene) is ranked on its own
+    rankColumnFile:<tabfile> like file:, but each column (sample) is ranked on its own
+    quantileFile:<tabfile>   like file:, but quantile normalized rather than ranked
     rawFile:<tabfile>        where <tabfile> is a file that won't be run
                              through quantile transformation
 
@@ -33,16 +59,47 @@ Options:
    -p dir               the directory containing pathway files 
                         (default is /hive/groups/cancerGB/paradigm/pathwayfiles/v1)
    -t str               use initial parameters stored from another params.txt
+   -w dir               parameter cache: EM starts from the nearest cached
+                        parameters of each attachment (-t takes precedence),
+                        and the converged parameters of this run are added
+                        to it (see paramCache.py)
    -i string            inference parameters 
                         (default is method=JTREE,updates=HUGIN,verbose=1)
    -c options           options to pass to createNullFiles.py (quote them all)
+   -j int               number of worker processes for evidence transforms and
+                        null batches (default: number of cpus, 0 runs the
+                        shell pipelines and writes null batches one by one)
+   -r int               master seed of the null batches (default: random,
+                        recorded in nullSeed.txt); a -r or -j given with -c
+                        takes precedence over this one and over -j
+   -l                   don't write the null batches to clusterFiles/, each
+                        null job generates its own samples into local scratch;
+                        the null lines of jobs.list then start with a
+                        lazyNull:<spec>:<batch>:<k>,<n> prefix that only
+                        jtParadigm.py and localParadigm.py can run, not a
+                        shell or a plain batch system
+   -u                   don't pack jobs shorter than the target length together
+   -k int               pack jobs down to no fewer than this many jobs per list,
+                        the number of workers the run should keep busy
+                        (default: 100)
+   -m file              runtime history: job lengths are predicted from it and
+                        the pathway timings.tab, and the jobs of this run are
+                        added to it once the run has finished
    -b flt;flt[,flt;flt] boundaries for discretization, use comma to specify different
                         boundaries per evidence (default 0.333;0.667)
    -q                   run quietly, don't output status
 """
 ## Written by: Charles Vaske
 ## Modified by: Sam Ng
-import os, sys, glob, getopt, re, subprocess, math, json
+import os, sys, glob, getopt, re, subprocess, math, json, shutil, random, shlex
+import multiprocessing
+import matrixCache
+import costModel
+import paramCache
+try:
+    import quantileTransform
+except ImportError:
+    quantileTransform = None
 
 ###
 ### Experiments to find the path of the currently executing script
@@ -53,11 +110,32 @@ import os, sys, glob, getopt, re, subprocess, math, json
 # print "os.path.dirname(sys.argv[0]):", os.path.dirname(sys.argv[0])
 # print "os.path.realpath(os.path.dirname(sys.argv[0])):", os.path.realpath(os.path.dirname(sys.argv[0]))
 scriptDirectory = os.path.realpath(os.path.dirname(sys.argv[0]))
+largeFileMemory = 4096 # MB, leaves headroom on 8 GB worker nodes
 evidenceTypes = {
     "file":  (("cat %%s" +
                " | %s %s/quantileTransform.py /dev/stdin") % (sys.executable, scriptDirectory)),
+    "largeFile":  (("cat %%s" +
+               " | %s %s/quantileTransform.py -m %i /dev/stdin") % (sys.executable, scriptDirectory, largeFileMemory)),
+    "rankRowFile":  (("cat %%s" +
+               " | %s %s/quantileTransform.py -n row /dev/stdin") % (sys.executable, scriptDirectory)),
+    "rankColumnFile":  (("cat %%s" +
+               " | %s %s/quantileTransform.py -n column /dev/stdin") % (sys.executable, scriptDirectory)),
+    "quantileFile":  (("cat %%s" +
+               " | %s %s/quantileTransform.py -n quantile /dev/stdin") % (sys.executable, scriptDirectory)),
     "rawFile":  "cat %s"
     }
+### In-process equivalents of evidenceTypes: (rank mode, out-of-core MB)
+### passed to quantileTransform.transformPath, None copies the file as is.
+### Types missing here always go through the shell pipeline.
+evidenceTransforms = {
+    "file": ("all", None),
+    "largeFile": ("all", largeFileMemory),
+    "rankRowFile": ("row", None),
+    "rankColumnFile": ("column", None),
+    "quantileFile": ("quantile", None),
+    "rawFile": None
+    }
+workerProcesses = multiprocessing.cpu_count()
 
 dataDir = "clusterFiles"
 #outputEmDir = "outputFilesEM"
@@ -83,11 +161,24 @@ dryrun = False
 nullOptions = ""
 nullBatches = 2
 nullBatchSize = 500
+nullSeed = None
+lazyNulls = False
+nullSpecFile = "nullSpec.json"
+### jobs.list lines starting with this tag are null jobs whose evidence is
+### generated by the job itself, see paradigmJobs.runLazyNull
+lazyNullTag = "lazyNull"
+### short jobs are packed into one line, their commands joined by this
+### (see paradigmJobs.jobParts)
+packShortJobs = True
+jobSeparator = " && "
+minPackedJobs = 100
 
 targetJobLength = 45 # seconds
+runtimeHistory = None
 
 disc = "0.333;0.667"
 paramFile = ""
+paramCacheDir = None
 
 ### If dogmaDir is defined, files in that directory are copied to the 
 ### destination directory.  Additionally, if the files 'configTop' or
@@ -159,22 +250,6 @@ def initParams(numBins, reverse=False):
         for i, j in enumerate(down):
             paramLines += "%s\t%s\t%s\n" % (i, 2, j)
         return paramLines
-def readParams(paramFile):
-    storedParams = {}
-    f = open(paramFile, "r")
-    f.readline()
-    for line in f:
-        if line.isspace():
-            continue
-        line = line.rstrip("\n\r")
-        if line.startswith(">"):
-            attachment = re.split("=", line)[-1]
-            storedParams[attachment] = ""
-        else:
-            storedParams[attachment] += "%s\n" % (line)
-    f.close()
-    return storedParams
-
 def writeBaseParamsFile(pfilename, evidence, storedParams = {}):
     writeHeader = not os.path.exists(pfilename)
     pfile = open(pfilename, "a")
@@ -208,25 +283,89 @@ def writeBaseParamsFile(pfilename, evidence, storedParams = {}):
                 mfile.close()
     pfile.close()
 
-def readPathwayTiming(directory):
-    tfile = open(directory + "/timings.tab", "r")
-    samplesline = tfile.readline().rstrip();
-    m = re.search('^#\s*samples\s*(\d+)\s*', samplesline)
-    if not m:
-        print "missing samples line on pathway timings"
-        sys.exit(1)
-    samples = int(m.group(1))
-    result = {}
-    for line in tfile:
-        timestring, pathway = line.rstrip().split("\t")
-        result[pathway] = float(timestring) / samples
-    return result
-
-def numBuckets(pathway, samples, timings, targetLength):
-    if pathway not in timings:
-        return 1
-    length = timings[pathway] * samples
-    return min(int(math.ceil(length / targetLength)), samples)
+def cachedParams(cacheDir, evidence, pathFiles):
+    """
+    The parameters of the nearest entries of a parameter cache for each
+    attachment, and the keys of this run, so that its converged
+    parameters are added to the cache
+    """
+    dogma = paramCache.dogmaDigest(configTopEM + configTop, dogmaDir)
+    pathways = paramCache.libraryDigest(pathFiles)
+    paramCache.writeRun(cacheDir, dogma, pathways,
+                        [(e["attachment"], e["disc"], e["suffix"]) for e in evidence])
+    storedParams = {}
+    entries = paramCache.readIndex(cacheDir)
+    for e in evidence:
+        entry = paramCache.nearest(entries, dogma, pathways, e["attachment"], e["disc"])
+        if entry is None:
+            log("    no cached parameters for %s\n" % e["attachment"])
+            continue
+        log("    %s starts from %s (logZ %g)\n" % (e["attachment"], entry["params"], entry["logZ"]))
+        storedParams[e["attachment"]] = paramCache.readEntry(entry)
+    return storedParams
+
+def numBuckets(pathway, samples, estimate, targetLength):
+    """buckets that bring the predicted length of each job under targetLength"""
+    length = estimate(pathway, samples)
+    return max(1, min(int(math.ceil(length / targetLength)), samples))
+
+def bucketSamples(samples, k, buckets):
+    """number of samples in bucket k of buckets"""
+    return (k + 1) * samples / buckets - k * samples / buckets
+
+def firstFit(jobs, targetLength, capacity):
+    """
+    Jobs shorter than targetLength packed first fit, longest first, into
+    combined jobs of at most capacity
+    """
+    packed = []
+    bins = []
+    for (cost, line) in sorted(jobs, key = lambda job: -job[0]):
+        if cost >= targetLength:
+            packed.append((cost, line))
+            continue
+        for b in bins:
+            if b[0] + cost <= capacity:
+                b[0] += cost
+                b[1].append(line)
+                break
+        else:
+            bins.append([cost, [line]])
+    for (cost, lines) in bins:
+        packed.append((cost, jobSeparator.join(lines)))
+    return packed
+
+def packJobs(jobs, targetLength, minJobs = 1):
+    """
+    Packs jobs predicted shorter than targetLength into combined jobs of
+    about targetLength, so short pathways do not each pay for scheduling
+    and paradigm start-up.  Combined jobs are kept short enough that at
+    least minJobs jobs remain (or all of them, if there are fewer), so
+    packing never takes away the parallelism of a cluster of that many
+    workers.
+    """
+    wanted = min(len(jobs), minJobs)
+    short = [cost for (cost, line) in jobs if cost < targetLength]
+    ## combined jobs no longer than this make about wanted of them; jobs
+    ## longer than it on their own can leave fewer, then it is lowered
+    capacity = min(targetLength,
+                   sum(short) / max(1, wanted - (len(jobs) - len(short))))
+    while True:
+        packed = firstFit(jobs, targetLength, capacity)
+        if len(packed) >= wanted:
+            return packed
+        capacity *= 0.9
+
+def writeJobList(filename, jobs):
+    """
+    Writes job lines longest predicted first, each ending with its
+    prediction as a shell comment (see paradigmJobs.readJobList)
+    """
+    jobs = sorted(jobs, key = lambda job: -job[0])
+    jfile = open(filename, "w")
+    for (cost, line) in jobs:
+        jfile.write("%s # estimate=%.1fs\n" % (line, cost))
+    jfile.close()
 
 def usage(code=0):
     print __doc__
@@ -243,6 +382,65 @@ def evidenceStreamCommand(evidenceSpec):
         usage(1)
     return (evidenceTypes[type] % name)
 
+def ingestEvidenceFile(job):
+    """transforms one evidence file in a worker, returns (spec, error)"""
+    (evidenceSpec, outFile) = job
+    (type, sep, name) = evidenceSpec.partition(":")
+    log("transforming %s into %s\n" % (name, outFile))
+    try:
+        if evidenceTransforms[type] is None:
+            shutil.copyfile(name, outFile)
+        else:
+            (rankMode, memoryMB) = evidenceTransforms[type]
+            quantileTransform.transformPath(name, outFile, rankMode, memoryMB)
+    except SystemExit, err:
+        return (evidenceSpec, "exited with status %s" % str(err.code))
+    except Exception, err:
+        return (evidenceSpec, str(err))
+    return (evidenceSpec, None)
+
+def ingestEvidence(evidence, processes):
+    """
+    Transforms the evidence files in a process pool, running any evidence
+    type without an in-process equivalent through its shell pipeline
+    """
+    jobs = []
+    for e in evidence:
+        (type, sep, name) = e["spec"].partition(":")
+        if quantileTransform is not None and type in evidenceTransforms:
+            jobs.append((e["spec"], e["suffix"]))
+        else:
+            syscmd(evidenceStreamCommand(e["spec"]) + " > " + e["suffix"])
+    if len(jobs) == 0:
+        return
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        results = pool.map(ingestEvidenceFile, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    failed = False
+    for (evidenceSpec, error) in results:
+        if error is not None:
+            print "Failed to transform %s: %s" % (evidenceSpec, error)
+            failed = True
+    if failed:
+        sys.exit(10)
+    log(" ... done\n")
+
+def cacheEvidence(files, processes):
+    """writes the binary matrixCache sidecar of every file"""
+    if processes > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(processes, len(files)))
+        try:
+            pool.map(matrixCache.writeCache, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for f in files:
+            matrixCache.writeCache(f)
+
 def evidenceStub(attachment, evidspec, index):
     (type, sep, name)= evidspec.partition(":")
     bname = os.path.basename(name)
@@ -266,6 +464,16 @@ def readFileLineNumber(filename):
                                 stdout=subprocess.PIPE).communicate()[0])
 
 
+def nullOption(option):
+    """the value -c gives a createNullFiles.py option, None if it is not given"""
+    words = shlex.split(nullOptions)
+    for i, word in enumerate(words):
+        if word == option and i + 1 < len(words):
+            return words[i + 1]
+        if word.startswith(option) and len(word) > len(option):
+            return word[len(option):]
+    return None
+
 def syscmd(cmd):
     log("running:\n    " + cmd + "\n")
     if dryrun:
@@ -290,7 +498,7 @@ def mkdir(dirname):
 def prepareParadigm(args):
     pathwayDir = '/hive/groups/cancerGB/paradigm/pathwayfiles/v1'
     try:
-        opts, args = getopt.getopt(args, "p:n:e:qc:b:s:t:i:d:")
+        opts, args = getopt.getopt(args, "p:n:e:qc:b:s:t:i:d:j:r:lm:uk:w:")
     except getopt.GetoptError, err:
         print str(err)
         usage(2)
@@ -300,8 +508,9 @@ def prepareParadigm(args):
         usage(1)
 
     global paradigmExec, dryrun, nullOptions, disc
-    global nullBatches, nullBatchSize, paramFile, inference, dogmaDir
-    global configTop, configTopEM
+    global nullBatches, nullBatchSize, paramFile, inference, dogmaDir, nullSeed
+    global configTop, configTopEM, workerProcesses, lazyNulls, runtimeHistory
+    global packShortJobs, minPackedJobs, paramCacheDir
     for o, a in opts:
         if o == "-p":
             pathwayDir = a
@@ -336,6 +545,20 @@ def prepareParadigm(args):
             paramFile = a
         elif o == "-i":
             inference = a
+        elif o == "-j":
+            workerProcesses = int(a)
+        elif o == "-r":
+            nullSeed = int(a)
+        elif o == "-l":
+            lazyNulls = True
+        elif o == "-m":
+            runtimeHistory = os.path.abspath(a)
+        elif o == "-u":
+            packShortJobs = False
+        elif o == "-k":
+            minPackedJobs = int(a)
+        elif o == "-w":
+            paramCacheDir = os.path.abspath(a)
         
     log("Making sub-directories\n")
     mkdir(dataDir)
@@ -350,15 +573,44 @@ def prepareParadigm(args):
         if (e["attachment"] not in standardAttach):
             print "WARNING: %s is non-standard: " % e["attachment"]
             print "         standard attachments are: " + str(standardAttach)
-        cmd = evidenceStreamCommand(e["spec"]) + " > " + e["suffix"]
-        syscmd(cmd)
-
-    cmd = "%s %s/createNullFiles.py %s -t %s -p %s/na_batch -b %i %s " % \
-        (sys.executable, scriptDirectory, nullOptions, dataDir, dataDir, 
+        evidenceStreamCommand(e["spec"])
+    if workerProcesses > 0 and not dryrun:
+        ingestEvidence(evidence, workerProcesses)
+    else:
+        for e in evidence:
+            cmd = evidenceStreamCommand(e["spec"]) + " > " + e["suffix"]
+            syscmd(cmd)
+
+    ## options given with -c take precedence over the ones made up here
+    generated = ""
+    if nullOption("-r") is not None:
+        nullSeed = int(nullOption("-r"))
+    else:
+        if nullSeed is None:
+            nullSeed = random.SystemRandom().randint(0, 2**31 - 1)
+        generated += "-r %i " % (nullSeed)
+    if nullOption("-j") is None:
+        generated += "-j %i " % (max(1, workerProcesses))
+    log("null batch seed %i\n" % nullSeed)
+    if not dryrun:
+        sfile = open("nullSeed.txt", "w")
+        sfile.write("%i\n" % nullSeed)
+        sfile.close()
+    if lazyNulls:
+        lazyOption = "-l " + nullSpecFile
+    else:
+        lazyOption = ""
+    cmd = "%s %s/createNullFiles.py %s %s%s -t %s -p %s/na_batch -b %i %s " % \
+        (sys.executable, scriptDirectory, nullOptions, generated,
+         lazyOption, dataDir, dataDir, 
          nullBatches, str(nullBatchSize)) \
         + " ".join([e["suffix"] for e in evidence])
     syscmd(cmd)
 
+    if not dryrun:
+        log("Caching evidence matrices\n")
+        cacheEvidence([e["outputFile"] for e in evidence], workerProcesses)
+
     # minus 1 for header
     samples = readFileLineNumber(evidence[0]["outputFile"]) - 1
 
@@ -396,20 +648,47 @@ def prepareParadigm(args):
 
     log("Copying pathway files\n")
     syscmd("cp %s/*_pathway.tab %s" % (pathwayDir, dataDir))
-    timings = readPathwayTiming(pathwayDir)
-    
     pathFiles = glob.glob(dataDir + "/*_pathway.tab")
 
+    log("Fitting job runtime model\n")
+    stats = costModel.readPathwayStats(pathwayDir)
+    for p in pathFiles:
+        if os.path.basename(p) not in stats:
+            stats[os.path.basename(p)] = costModel.pathwayStats(p)
+    observations = costModel.readTimings(pathwayDir, len(evidence), stats)
+    if runtimeHistory is not None:
+        observations += costModel.readHistory(runtimeHistory)
+        hfile = open("runtimeHistory.txt", "w")
+        hfile.write("%s\n" % runtimeHistory)
+        hfile.close()
+    model = costModel.CostModel(observations)
+    if model.weights is None:
+        print "no pathway timings in %s and no runtime history" % pathwayDir
+        print "measure them with: timePathways.py -e %s %s" % (paradigmExec, pathwayDir)
+        sys.exit(1)
+    log("    %i observed jobs\n" % model.count)
+    def estimate(pathway, samples):
+        (nodes, edges) = stats[pathway]
+        return model.predict(pathway, samples, len(evidence), nodes, edges)
+    ffile = open(costModel.featuresFile, "w")
+    ffile.write("# output\tpathway\tsamples\tevidence\tnodes\tedges\n")
+    def addJob(jobs, line, out, pathway, samples):
+        (nodes, edges) = stats[pathway]
+        ffile.write("%s\t%s\t%i\t%i\t%i\t%i\n" % 
+                    (out, pathway, samples, len(evidence), nodes, edges))
+        jobs.append((estimate(pathway, samples), line.rstrip("\n")))
+
     log("writing EM jobs list\n")
-    jfile = open("jobsEM.list", "w")
+    jobs = []
     for p in pathFiles:
         pathway = os.path.basename(p)
-        buckets = numBuckets(pathway, samples, timings, targetJobLength)
+        buckets = numBuckets(pathway, samples, estimate, targetJobLength)
         pid = pathway[0:-len("_pathway.tab")]
         if buckets == 1:
             emOut = "outputFilesEM/" + pid + "_learned_parameters.fa"
-            jfile.write("%s -p %s -c configEM.txt -b %s/ -e %s\n" % 
-                        (paradigmExec, p, dataDir, emOut))
+            c = "%s -p %s -c configEM.txt -b %s/ -e %s\n" % \
+                (paradigmExec, p, dataDir, emOut)
+            addJob(jobs, c, emOut, pathway, samples)
         else:
             for b in range(buckets):
                 bpid = "%s_b%i_%i" % (pid, b, buckets)
@@ -417,39 +696,55 @@ def prepareParadigm(args):
                 out = "outputFilesEM/" + bpid + "_output.fa"
                 c = "%s -p %s -c configEM.txt -b%s/ -e %s -s %i,%i\n" % \
                     (paradigmExec, p, dataDir, emOut, b, buckets)
-                jfile.write(c)
-
-    jfile.close()
+                addJob(jobs, c, emOut, pathway, bucketSamples(samples, b, buckets))
+    if packShortJobs:
+        jobs = packJobs(jobs, targetJobLength, minPackedJobs)
+    writeJobList("jobsEM.list", jobs)
 
     log("writing jobs list\n")
-    jfile = open("jobs.list", "w")
+    jobs = []
     for p in pathFiles:
         pathway = os.path.basename(p)
-        buckets = numBuckets(pathway, samples, timings, targetJobLength)
+        buckets = numBuckets(pathway, samples, estimate, targetJobLength)
         pid = pathway[0:-len("_pathway.tab")]
         if (buckets == 1):
             out = "outputFiles/" + pid + "_output.fa"
-            jfile.write("%s -p %s -c config.txt -b %s/ -o %s\n" % 
-                        (paradigmExec, p, dataDir, out))
+            c = "%s -p %s -c config.txt -b %s/ -o %s\n" % \
+                (paradigmExec, p, dataDir, out)
+            addJob(jobs, c, out, pathway, samples)
         else:
             for b in range(buckets):
                 bpid = "%s_b%i_%i" % (pid, b, buckets)
                 out = "outputFiles/" + bpid + "_output.fa"
                 c = "%s -p %s -c config.txt -b %s/ -o %s -s %i,%i\n" % \
                     (paradigmExec, p, dataDir, out, b, buckets)
-                jfile.write(c)
+                addJob(jobs, c, out, pathway, bucketSamples(samples, b, buckets))
         for b in range(1, 1 + nullBatches):
             if nullBatchSize == "same":
                 numNullSamples = samples
             else:
                 numNullSamples = nullBatchSize
             buckets = numBuckets(pathway, numNullSamples, 
-                                 timings, targetJobLength)
-            if buckets == 1:
+                                 estimate, targetJobLength)
+            if lazyNulls:
+                ## the job writes only its bucket of the batch, so paradigm
+                ## runs on all of the samples it is given
+                for k in range(buckets):
+                    if buckets == 1:
+                        out = "outputFiles/" + pid + "_batch_" + str(b) + "_output.fa"
+                    else:
+                        bpid = "%s_b%i_%i" % (pid, k, buckets)
+                        out = "outputFiles/%s_batch_%s_output.fa" % (bpid, str(b))
+                    c = "%s:%s:%i:%i,%i %s -p %s -c config.txt -b $NULLDIR/na_batch_%i_ -o %s\n" % \
+                        (lazyNullTag, nullSpecFile, b, k, buckets,
+                         paradigmExec, p, b, out)
+                    addJob(jobs, c, out, pathway, 
+                           bucketSamples(numNullSamples, k, buckets))
+            elif buckets == 1:
                 out = "outputFiles/" + pid + "_batch_" + str(b) + "_output.fa"
                 c = "%s -p %s -c config.txt -b %s/na_batch_%i_ -o %s\n" % \
                     (paradigmExec, p, dataDir, b, out)
-                jfile.write(c)
+                addJob(jobs, c, out, pathway, numNullSamples)
             else:
                 for k in range(buckets):
                     bpid = "%s_b%i_%i" % (pid, k, buckets)
@@ -457,13 +752,19 @@ def prepareParadigm(args):
                     batch = "%s/na_batch_%i_" % (dataDir, b)
                     c = "%s -p %s -c config.txt -b %s -o %s -s %i,%i\n" % \
                         (paradigmExec, p, batch, out, k, buckets)
-                    jfile.write(c)
-    jfile.close()
+                    addJob(jobs, c, out, pathway, 
+                           bucketSamples(numNullSamples, k, buckets))
+    if packShortJobs:
+        jobs = packJobs(jobs, targetJobLength, minPackedJobs)
+    writeJobList("jobs.list", jobs)
+    ffile.close()
     
+    storedParams = {}
+    if paramCacheDir is not None:
+        storedParams = cachedParams(paramCacheDir, evidence, pathFiles)
     if len(paramFile) > 0:
-        writeBaseParamsFile("params0.txt", evidence, storedParams = readParams(paramFile))
-    else:
-        writeBaseParamsFile("params0.txt", evidence)
+        storedParams.update(paramCache.readParams(paramFile))
+    writeBaseParamsFile("params0.txt", evidence, storedParams = storedParams)
     
     syscmd("ln -s params0.txt params.txt")
 
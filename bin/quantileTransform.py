@@ -7,11 +7,40 @@ import csv
 import math
 import ctypes
 import ctypes.util
+import os
+import shutil
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 libc = ctypes.cdll.LoadLibrary(ctypes.util.find_library("c"))
 
 verbose = False;
 
+if numpy is not None:
+    engine = "numpy"
+else:
+    engine = "qsort"
+engines = ["numpy", "qsort"]
+
+## number of output lines joined into a single write by the numpy engine
+writeChunkLines = 256
+
+## what each value is ranked against: the whole matrix (all), its row,
+## its column, or quantile normalization of every column onto a
+## reference distribution (quantile)
+mode = "all"
+modes = ["all", "row", "column", "quantile"]
+referenceFile = None
+
+## out-of-core mode: memory budget in MB (None keeps everything in memory)
+## and the directory that receives the sorted runs
+externalMemory = None
+tempDir = None
+
 def usage(code=0):
     print "quantileTransform.py: rank transform an evidence file for Paradigm"
     print ""
@@ -20,6 +49,15 @@ def usage(code=0):
     print "Options:"
     print "  -r int   number of header rows"
     print "  -c int   number of header columns "
+    print "  -e str   transform engine: numpy (default when available) or qsort"
+    print "  -n str   mode: all (default) ranks against the whole matrix,"
+    print "           row or column rank within each row or column, quantile"
+    print "           quantile normalizes each column (needs numpy)"
+    print "  -R file  reference matrix whose values give the quantile distribution"
+    print "           (default: the mean of the sorted columns)"
+    print "  -m int   out-of-core mode: keep at most about int MB in memory,"
+    print "           spilling sorted runs to temporary files (needs numpy)"
+    print "  -T dir   directory for out-of-core temporary files"
     print "  -v       print progress reports to stderr"
     if (code != None):
         sys.exit(code)
@@ -39,6 +77,9 @@ def printElapsed(start):
 def py_cmp_float(a_ptr, b_ptr):
     a = a_ptr.contents.value
     b = b_ptr.contents.value
+    ## nan sorts last, otherwise qsort sees an inconsistent ordering
+    if a != a or b != b:
+        return (a != a) - (b != b)
     return (a > b) - (a < b)
 
 CMPFUNC = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_float))
@@ -53,7 +94,36 @@ def csort(buf):
     libc.qsort( ctypes.cast(addr, ctypes.POINTER(ctypes.c_float)), count, ctypes.sizeof(ctypes.c_float), cmp_float)     
 
 
-def transformFile(fh, sep="\t"):
+def transformFile(fh, sep="\t", out=None):
+    if out is None:
+        out = sys.stdout
+    if externalMemory is not None:
+        transformFileExternal(fh, sep, externalMemory, tempDir, out)
+    elif engine == "numpy":
+        transformFileNumpy(fh, sep, out, mode, referenceFile)
+    else:
+        transformFileQsort(fh, sep, out)
+
+def transformPath(inFile, outFile, rankMode="all", memoryMB=None, sep="\t"):
+    """
+    Transforms inFile into outFile; the entry point for running the
+    transform inside another script rather than through a shell pipe
+    """
+    fh = open(inFile, "r")
+    out = open(outFile, "w")
+    try:
+        if memoryMB is not None:
+            transformFileExternal(fh, sep, memoryMB, tempDir, out)
+        elif engine == "numpy":
+            transformFileNumpy(fh, sep, out, rankMode)
+        else:
+            assert rankMode == "all", "mode %s needs numpy" % rankMode
+            transformFileQsort(fh, sep, out)
+    finally:
+        out.close()
+        fh.close()
+
+def transformFileQsort(fh, sep="\t", out=sys.stdout):
     startTime = time.time()
     log("reading file...")
     
@@ -114,15 +184,345 @@ def transformFile(fh, sep="\t"):
             else: return "NA"
         return "\t".join(map(matrixVal, range(numRows)))
 
-    print "samples\t%s" % ("\t".join(rows))
+    out.write("samples\t%s\n" % ("\t".join(rows)))
     for j in range(numCols):
-        print "%s\t%s" % (cols[j], rowString(j))
+        out.write("%s\t%s\n" % (cols[j], rowString(j)))
     log("wrote transposed matrix")
     printElapsed(startTime)
 
+def parseRowNumpy(fields):
+    """
+    Converts the fields of one row to float32, unparseable fields become
+    nan; returns the values and the number of fields that parsed
+    """
+    try:
+        vals = numpy.array(fields, dtype=numpy.float64)
+        count = len(fields)
+    except ValueError:
+        vals = numpy.empty(len(fields), dtype=numpy.float64)
+        count = 0
+        for i, val in enumerate(fields):
+            try:
+                vals[i] = float(val)
+                count += 1
+            except ValueError:
+                vals[i] = numpy.nan
+    return (vals.astype(numpy.float32), count)
+
+def readMatrixNumpy(fh, sep="\t"):
+    """
+    Reads a tab file into a float32 numpy block; returns the row names,
+    column names, the block and the number of cells that parsed as floats
+    """
+    cols = None
+    rows = []
+    blocks = []
+    totalValues = 0
+    reader = csv.reader(fh, delimiter=sep)
+    for row in reader:
+        if cols is None:
+            cols = row[1:]
+            numCols = len(cols)
+            continue
+        rows.append(row[0])
+        assert(len(row)-1 == numCols)
+        (vals, count) = parseRowNumpy(row[1:])
+        blocks.append(vals)
+        totalValues += count
+    if cols is None:
+        cols = []
+    if len(blocks) > 0:
+        values = numpy.vstack(blocks)
+    else:
+        values = numpy.empty((0, len(cols)), dtype=numpy.float32)
+    return (rows, cols, values, totalValues)
+
+def rankMatrixNumpy(values, totalValues):
+    """
+    Replaces every value by the rank of its last occurrence in the sorted
+    non-missing values divided by totalValues, missing values stay nan
+    """
+    present = ~numpy.isnan(values)
+    sortedValues = numpy.sort(values[present])
+    ranks = numpy.searchsorted(sortedValues, values, side="right") - 1
+    ranks = ranks / float(totalValues)
+    ranks[~present] = numpy.nan
+    return ranks
+
+def withinRanksNumpy(values, axis):
+    """
+    For every value, the number of values in its row (axis=1) or column
+    (axis=0) that are less than or equal to it, minus one; also returns the
+    number of non-missing values of each row or column
+    """
+    if axis == 0:
+        (index, counts) = withinRanksNumpy(values.T, 1)
+        return (index.T, counts)
+    present = ~numpy.isnan(values)
+    counts = present.sum(axis=1)
+    ## integer keys ordered by (row, value), missing values last in a row
+    (distinct, codes) = numpy.unique(values[present], return_inverse=True)
+    keys = numpy.empty(values.shape, dtype=numpy.int64)
+    keys[present] = codes
+    keys[~present] = len(distinct)
+    rowStarts = numpy.arange(values.shape[0], dtype=numpy.int64)
+    keys += (rowStarts * (len(distinct) + 1))[:, numpy.newaxis]
+    sortedKeys = numpy.sort(keys, axis=None)
+    index = numpy.searchsorted(sortedKeys, keys, side="right") - 1
+    index -= (rowStarts * values.shape[1])[:, numpy.newaxis]
+    return (index, counts)
+
+def rankWithinNumpy(values, axis):
+    """
+    Rank transform of every row (axis=1) or column (axis=0) on its own,
+    dividing by the number of values present in that row or column
+    """
+    (index, counts) = withinRanksNumpy(values, axis)
+    totals = numpy.maximum(counts, 1).astype(numpy.float64)
+    if axis == 1:
+        ranks = index / totals[:, numpy.newaxis]
+    else:
+        ranks = index / totals[numpy.newaxis, :]
+    ranks[numpy.isnan(values)] = numpy.nan
+    return ranks
+
+def quantileNormalizeNumpy(values, reference=None):
+    """
+    Maps every column onto a sorted reference distribution: a value at
+    quantile q of its column becomes the reference value at quantile q.
+    Without a reference, the mean of the sorted columns is used.
+    """
+    (index, counts) = withinRanksNumpy(values, 0)
+    spans = numpy.maximum(counts - 1, 1).astype(numpy.float64)
+    quantiles = index / spans[numpy.newaxis, :]
+    if reference is None:
+        ## interpolate every sorted column onto a common grid and average
+        columns = numpy.sort(values, axis=0)
+        length = max(1, counts.max())
+        grid = numpy.linspace(0.0, 1.0, length)[:, numpy.newaxis]
+        position = grid * (numpy.maximum(counts, 1) - 1)[numpy.newaxis, :]
+        low = numpy.floor(position).astype(numpy.int64)
+        high = numpy.minimum(low + 1, numpy.maximum(counts - 1, 0)[numpy.newaxis, :])
+        fraction = position - low
+        cols = numpy.arange(values.shape[1])[numpy.newaxis, :]
+        interpolated = (columns[low, cols] * (1.0 - fraction) +
+                        columns[high, cols] * fraction)
+        interpolated = interpolated[:, counts > 0]
+        if interpolated.shape[1] == 0:
+            return numpy.where(numpy.isnan(values), numpy.nan, 0.0)
+        reference = interpolated.mean(axis=1)
+    if len(reference) == 0:
+        assert False, "empty reference distribution"
+    grid = numpy.linspace(0.0, 1.0, len(reference))
+    normalized = numpy.interp(quantiles, grid, reference)
+    normalized[numpy.isnan(values)] = numpy.nan
+    return normalized
+
+def writeRankLinesNumpy(out, names, lineRanks):
+    """
+    Writes one line per name, lineRanks holds the matching ranks row by row
+    """
+    rowFormat = "\t%5g" * lineRanks.shape[1]
+    lines = []
+    for j, ranks in enumerate(lineRanks):
+        line = rowFormat % tuple(ranks.tolist())
+        lines.append("%s%s\n" % (names[j], line.replace("\t  nan", "\tNA")))
+        if len(lines) >= writeChunkLines:
+            out.write("".join(lines))
+            lines = []
+    out.write("".join(lines))
+
+def writeTransposedNumpy(out, rows, cols, ranks):
+    out.write("samples\t%s\n" % ("\t".join(rows)))
+    writeRankLinesNumpy(out, cols, ranks.T)
+
+def transformFileNumpy(fh, sep="\t", out=sys.stdout, rankMode="all",
+                       referenceFile=None):
+    startTime = time.time()
+    log("reading file...")
+
+    (rows, cols, values, totalValues) = readMatrixNumpy(fh, sep)
+    (numRows, numCols) = (len(rows), len(cols))
+    if (numRows == 0):
+        print "Empty input"
+        exit(10)
+
+    log("read %i rows %i columns" % (numRows, numCols))
+    printElapsed(startTime)
+
+    if totalValues == 0:
+        assert False, "did not read any values"
+    log("%f%% missing data\n" % (100 - 100*float(totalValues)
+                      / ((numRows) * (numCols))))
+    printElapsed(startTime)
+
+    log("sorting float values...")
+    if rankMode == "row":
+        ranks = rankWithinNumpy(values, 1)
+    elif rankMode == "column":
+        ranks = rankWithinNumpy(values, 0)
+    elif rankMode == "quantile":
+        if referenceFile is not None:
+            rfile = open(referenceFile, "r")
+            reference = readMatrixNumpy(rfile, sep)[2]
+            rfile.close()
+            reference = numpy.sort(reference[~numpy.isnan(reference)])
+        else:
+            reference = None
+        ranks = quantileNormalizeNumpy(values, reference)
+    else:
+        ranks = rankMatrixNumpy(values, totalValues)
+
+    log("rank transformed all data\n")
+    printElapsed(startTime)
+
+    writeTransposedNumpy(out, rows, cols, ranks)
+    log("wrote transposed matrix")
+    printElapsed(startTime)
+
+def writeSortedRun(runFile, values):
+    """
+    Sorts the non-missing values of a block and writes them as float32
+    """
+    run = numpy.sort(values[~numpy.isnan(values)], axis=None)
+    f = open(runFile, "wb")
+    run.tofile(f)
+    f.close()
+    return len(run)
+
+def mergeSortedRuns(runs, valueFile, countFile, bufferValues):
+    """
+    k-way merge of sorted float32 runs, bufferValues at a time from each run.
+    Writes the merged values to valueFile and, for each of them, the number
+    of values less than or equal to it to countFile.  A value may appear
+    more than once in valueFile; the last entry holds its full count.
+    """
+    vout = open(valueFile, "wb")
+    cout = open(countFile, "wb")
+    positions = [0] * len(runs)
+    active = range(len(runs))
+    merged = 0
+    while len(active) > 0:
+        buffers = [runs[k][positions[k]:positions[k]+bufferValues] for k in active]
+        bound = min([b[-1] for b in buffers])
+        parts = []
+        for k, b in zip(active, buffers):
+            n = numpy.searchsorted(b, bound, side="right")
+            parts.append(numpy.asarray(b[:n]))
+            positions[k] += n
+        block = numpy.sort(numpy.concatenate(parts))
+        (values, counts) = numpy.unique(block, return_counts=True)
+        values.tofile(vout)
+        (numpy.cumsum(counts) + merged).astype(numpy.int64).tofile(cout)
+        merged += len(block)
+        active = [k for k in active if positions[k] < len(runs[k])]
+    vout.close()
+    cout.close()
+    return merged
+
+def transformFileExternal(fh, sep="\t", memoryMB=1024, tmpDir=None,
+                          out=sys.stdout):
+    """
+    Rank transforms a matrix that does not fit in memory: the parsed values
+    are spilled to disk along with sorted runs of at most memoryMB, the runs
+    are merged into a table of global ranks and the transposed matrix is
+    written a block of columns at a time.  Output matches transformFileNumpy.
+    """
+    startTime = time.time()
+    workDir = tempfile.mkdtemp(prefix="quantileTransform.", dir=tmpDir)
+    try:
+        memoryBytes = int(memoryMB * 1024 * 1024)
+        matrixFile = os.path.join(workDir, "matrix.f32")
+        log("reading file and writing sorted runs...")
+        mout = open(matrixFile, "wb")
+        cols = None
+        rows = []
+        block = []
+        runs = []
+        totalValues = 0
+        reader = csv.reader(fh, delimiter=sep)
+        for row in reader:
+            if cols is None:
+                cols = row[1:]
+                numCols = len(cols)
+                ## parsed block, its sorted copy and the parse buffers
+                chunkRows = max(1, memoryBytes / (12 * max(1, numCols)))
+                continue
+            rows.append(row[0])
+            assert(len(row)-1 == numCols)
+            (vals, count) = parseRowNumpy(row[1:])
+            block.append(vals)
+            totalValues += count
+            if len(block) >= chunkRows:
+                values = numpy.vstack(block)
+                values.tofile(mout)
+                runFile = os.path.join(workDir, "run%i.f32" % len(runs))
+                if writeSortedRun(runFile, values) > 0:
+                    runs.append(runFile)
+                block = []
+        if len(block) > 0:
+            values = numpy.vstack(block)
+            values.tofile(mout)
+            runFile = os.path.join(workDir, "run%i.f32" % len(runs))
+            if writeSortedRun(runFile, values) > 0:
+                runs.append(runFile)
+            block = []
+        mout.close()
+        numRows = len(rows)
+        if (numRows == 0):
+            print "Empty input"
+            exit(10)
+
+        log("read %i rows %i columns into %i runs" % (numRows, numCols, len(runs)))
+        printElapsed(startTime)
+
+        if totalValues == 0:
+            assert False, "did not read any values"
+        log("%f%% missing data\n" % (100 - 100*float(totalValues)
+                          / ((numRows) * (numCols))))
+        printElapsed(startTime)
+
+        log("merging sorted runs...")
+        valueFile = os.path.join(workDir, "values.f32")
+        countFile = os.path.join(workDir, "counts.i64")
+        runMaps = [numpy.memmap(r, dtype=numpy.float32, mode="r") for r in runs]
+        bufferValues = max(4096, memoryBytes / (8 * (len(runs) + 1)))
+        if mergeSortedRuns(runMaps, valueFile, countFile, bufferValues) > 0:
+            rankValues = numpy.memmap(valueFile, dtype=numpy.float32, mode="r")
+            rankCounts = numpy.memmap(countFile, dtype=numpy.int64, mode="r")
+        else:
+            ## every parsed value was nan
+            rankValues = numpy.zeros(0, dtype=numpy.float32)
+            rankCounts = numpy.zeros(1, dtype=numpy.int64)
+        del runMaps
+        for r in runs:
+            os.remove(r)
+        log("rank table built\n")
+        printElapsed(startTime)
+
+        log("writing transposed matrix...")
+        matrix = numpy.memmap(matrixFile, dtype=numpy.float32, mode="r",
+                              shape=(numRows, numCols))
+        ## column block, its ranks and the formatted lines
+        blockCols = max(1, memoryBytes / (24 * numRows))
+        out.write("samples\t%s\n" % ("\t".join(rows)))
+        for j in range(0, numCols, blockCols):
+            values = numpy.array(matrix[:, j:j+blockCols].T)
+            present = ~numpy.isnan(values)
+            index = numpy.searchsorted(rankValues, values, side="right") - 1
+            index[~present] = 0
+            ranks = (rankCounts[index] - 1) / float(totalValues)
+            ranks[~present] = numpy.nan
+            writeRankLinesNumpy(out, cols[j:j+blockCols], ranks)
+        del matrix, rankValues, rankCounts
+        log("wrote transposed matrix")
+        printElapsed(startTime)
+    finally:
+        shutil.rmtree(workDir, True)
+
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv[1:], "v")
+        opts, args = getopt.getopt(argv[1:], "ve:m:T:n:R:")
     except getopt.GetoptError, err:
         print str(err)
         usage(2)
@@ -134,13 +534,39 @@ def main(argv):
     else:
         usage(1)
 
-    global verbose
+    global verbose, engine, externalMemory, tempDir, mode, referenceFile
     for o, a in opts:
         if o == "-v":
             verbose = True;
+        elif o == "-e":
+            if a not in engines:
+                print "unknown engine %s, choose from %s" % (a, ", ".join(engines))
+                usage(1)
+            if a == "numpy" and numpy is None:
+                print "numpy engine requested but numpy is not installed"
+                usage(1)
+            engine = a
+        elif o == "-m":
+            externalMemory = int(a)
+        elif o == "-T":
+            tempDir = a
+        elif o == "-n":
+            if a not in modes:
+                print "unknown mode %s, choose from %s" % (a, ", ".join(modes))
+                usage(1)
+            mode = a
+        elif o == "-R":
+            referenceFile = a
         else:
             assert False, "unhandled option"
     
+    if externalMemory is not None and numpy is None:
+        print "out-of-core mode needs numpy"
+        usage(1)
+    if mode != "all" and (engine != "numpy" or externalMemory is not None):
+        print "mode %s needs the in-memory numpy engine" % mode
+        usage(1)
+
     transformFile(fh)
 
 if __name__ == "__main__":
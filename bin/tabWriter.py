@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""tabWriter.py: fast writer for tab-separated matrices
+
+Rows are formatted whole with a single format operation, missing values
+(nan, or empty fields of text rows) are replaced in the formatted line
+rather than checked cell by cell, and lines are handed to the file in
+large joined writes.
+
+Run on its own it benchmarks the writer against a cell by cell writer.
+
+Usage:
+  tabWriter.py [options]
+
+Options:
+  -r int    rows of the benchmark matrix (default: 10000)
+  -c int    columns of the benchmark matrix (default: 20000)
+  -n int    rows written by the cell by cell writer, its throughput is
+            measured on these alone (default: 200)
+  -o file   write the benchmark matrix here (default: a temporary file)
+  -q        run quietly
+"""
+import os, sys, getopt, math, time, random, tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+verbose = True
+
+## bytes of formatted lines collected before they are written
+bufferSize = 1 << 22
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def replaceNull(line, find, null, sep = "\t"):
+    """
+    Replaces every field of line equal to find, other than the first, with
+    null; two passes since neighbouring fields share a separator
+    """
+    if find not in line:
+        return line
+    find = sep + find + sep
+    null = sep + null + sep
+    line = (line + sep).replace(find, null).replace(find, null)
+    return line[:-len(sep)]
+
+class TabWriter:
+    """
+    Writes the lines of a tab file through a buffer; floats are written
+    as str() would write them and nan as null
+    """
+    def __init__(self, out, sep = "\t", null = "NA"):
+        if isinstance(out, basestring):
+            self.fh = open(out, "w")
+            self.ownFile = True
+        else:
+            self.fh = out
+            self.ownFile = False
+        self.sep = sep
+        self.null = null
+        self.lines = []
+        self.size = 0
+        self.formats = {}
+    def rowFormat(self, numFields):
+        if numFields not in self.formats:
+            self.formats[numFields] ="%s" + (self.sep + "%s") * numFields
+        return self.formats[numFields]
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size >= bufferSize:
+            self.flush()
+    def writeHeader(self, corner, colnames):
+        self.append("%s\n" % (self.sep.join([corner] + list(colnames))))
+    def writeRow(self, label, vals):
+        """a row of numbers (or strings), nan is written as null"""
+        if numpy is not None and isinstance(vals, numpy.ndarray):
+            vals = vals.tolist()
+        line = self.rowFormat(len(vals)) % ((label,) + tuple(vals))
+        self.append(replaceNull(line, "nan", self.null, self.sep) + "\n")
+    def writeRows(self, labels, block):
+        """rows of a 2-D numpy block, or any sequence of rows"""
+        for label, vals in zip(labels, block):
+            self.writeRow(label, vals)
+    def writeFields(self, label, fields):
+        """a row of text fields, empty fields are written as null"""
+        line = self.sep.join([label] + list(fields))
+        self.append(replaceNull(line, "", self.null, self.sep) + "\n")
+    def flush(self):
+        if len(self.lines) > 0:
+            self.fh.write("".join(self.lines))
+            self.lines = []
+            self.size = 0
+    def close(self):
+        self.flush()
+        if self.ownFile:
+            self.fh.close()
+
+def writeMatrix(filename, corner, colnames, rownames, values, sep = "\t", null = "NA"):
+    """writes a matrix given as a 2-D numpy block or a sequence of rows"""
+    w = TabWriter(filename, sep, null)
+    w.writeHeader(corner, colnames)
+    w.writeRows(rownames, values)
+    w.close()
+
+def writeCellByCell(fh, label, vals, sep = "\t", null = "NA"):
+    """one write and one nan check per cell, for comparison"""
+    fh.write(label)
+    for v in vals:
+        fh.write(sep)
+        if not math.isnan(v):
+            fh.write(str(v))
+        else:
+            fh.write(null)
+    fh.write("\n")
+
+def benchmarkBlock(numRows, numCols, rng):
+    """a block of float32 values with about 1% missing"""
+    if numpy is not None:
+        block = rng.standard_normal((numRows, numCols)).astype(numpy.float32)
+        block[rng.random_sample((numRows, numCols)) < 0.01] = numpy.nan
+        return block
+    block = []
+    for i in range(numRows):
+        row = [rng.gauss(0, 1) for j in range(numCols)]
+        for j in range(numCols):
+            if rng.random() < 0.01:
+                row[j] = float("nan")
+        block.append(row)
+    return block
+
+def benchmark(numRows, numCols, numCellRows, outFile):
+    if numpy is not None:
+        rng = numpy.random.RandomState(0)
+    else:
+        rng = random.Random(0)
+    colnames = ["c%i" % j for j in range(numCols)]
+    blockRows = 256
+
+    ## the fast writer, fed in blocks so the matrix is never held whole
+    start = time.time()
+    generated = 0.0
+    w = TabWriter(outFile)
+    w.writeHeader("id", colnames)
+    for r in range(0, numRows, blockRows):
+        t = time.time()
+        block = benchmarkBlock(min(blockRows, numRows - r), numCols, rng)
+        generated += time.time() - t
+        w.writeRows(["r%i" % i for i in range(r, r + len(block))], block)
+    w.close()
+    elapsed = time.time() - start - generated
+    size = os.path.getsize(outFile) / float(1 << 20)
+    print "TabWriter: %i x %i, %.1f MB in %.2fs, %.1f MB/s" \
+        % (numRows, numCols, size, elapsed, size / elapsed)
+
+    ## the cell by cell writer on the first rows only
+    block = benchmarkBlock(numCellRows, numCols, rng)
+    if numpy is not None:
+        block = block.tolist()
+    start = time.time()
+    fh = open(outFile, "w")
+    writeCellByCell(fh, "id", [float(j) for j in range(numCols)])
+    for i, row in enumerate(block):
+        writeCellByCell(fh, "r%i" % i, row)
+    fh.close()
+    elapsed = time.time() - start
+    size = os.path.getsize(outFile) / float(1 << 20)
+    print "cell by cell: %i x %i, %.1f MB in %.2fs, %.1f MB/s" \
+        % (numCellRows, numCols, size, elapsed, size / elapsed)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "r:c:n:o:q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 0:
+        print "incorrect number of arguments"
+        usage(1)
+    numRows = 10000
+    numCols = 20000
+    numCellRows = 200
+    outFile = None
+    global verbose
+    for o, a in opts:
+        if o == "-r":
+            numRows = int(a)
+        elif o == "-c":
+            numCols = int(a)
+        elif o == "-n":
+            numCellRows = int(a)
+        elif o == "-o":
+            outFile = a
+        elif o == "-q":
+            verbose = False
+    removeOut = outFile is None
+    if removeOut:
+        (fd, outFile) = tempfile.mkstemp(suffix = ".tab")
+        os.close(fd)
+    log("writing benchmark matrices to %s\n" % (outFile))
+    try:
+        benchmark(numRows, numCols, numCellRows, outFile)
+    finally:
+        if removeOut:
+            os.remove(outFile)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
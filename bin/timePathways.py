@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""timePathways.py: benchmark paradigm on every pathway of a pathway library
+
+Runs the paradigm executable on a small synthetic cohort against every
+*_pathway.tab of a pathway directory, several pathways at a time, and
+writes the measured times in the format prepareParadigm.py reads.
+
+Each pathway is run twice, on one sample and on the whole cohort.  The
+difference of the two times is the inference of the other n-1 samples;
+paradigm's start-up and junction tree construction, which do not grow
+with the samples, cancel out and are left out of timings.tab.
+
+Creates in the output directory (default: the pathway directory):
+  timings.tab       "# samples <n>" and then the seconds of inference each
+                    pathway takes on n samples, without the fixed start-up
+  pathwayStats.tab  the number of nodes and edges of each pathway
+
+Usage:
+  timePathways.py [options] pathwayDir
+
+Options:
+  -e path    path to paradigm exe (default: /hive/users/$USER/bin/paradigm)
+  -n int     samples in the synthetic cohort, at least 2 (default: 20)
+  -j int     pathways run at the same time (default: number of cpus)
+  -o dir     write timings.tab and pathwayStats.tab here
+  -k         keep the scratch directory of the cohort and outputs
+  -q         run quietly
+"""
+import os, sys, glob, getopt, random, shutil, tempfile, time
+import multiprocessing
+import costModel
+import prepareParadigm
+
+verbose = True
+
+## the cohort is ranked evidence on the protein nodes of the pathways
+attachments = ["genome", "mRNA"]
+nodeType = "protein"
+
+def usage(code = 0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def pathwayGenes(pathFiles):
+    genes = set()
+    for p in pathFiles:
+        f = open(p, "r")
+        for line in f:
+            pline = line.rstrip("\r\n").split("\t")
+            if len(pline) == 2 and pline[0] == nodeType:
+                genes.add(pline[1])
+        f.close()
+    return sorted(genes)
+
+def writeCohort(scratch, genes, samples):
+    """
+    Writes uniform random evidence (as if rank transformed) for every
+    attachment, with the configuration and initial parameters to run it
+    """
+    rng = random.Random(0)
+    evidence = []
+    for a in attachments:
+        suffix = "%s.tab" % (a)
+        f = open(os.path.join(scratch, suffix), "w")
+        f.write("id\t%s\n" % ("\t".join(genes)))
+        for s in range(samples):
+            f.write("sample%i\t%s\n" % (s, "\t".join(["%.4f" % rng.random() for g in genes])))
+        f.close()
+        evidence.append({"attachment" : a, "suffix" : suffix,
+                         "disc" : prepareParadigm.disc})
+    f = open(os.path.join(scratch, "config.txt"), "w")
+    f.write(prepareParadigm.configTop % prepareParadigm.inference)
+    [f.write(prepareParadigm.configELine(e)) for e in evidence]
+    f.close()
+    prepareParadigm.writeBaseParamsFile(os.path.join(scratch, "params.txt"), evidence)
+
+def runPathway(paradigmExec, cohort, pathFile):
+    """runs paradigm on one pathway and cohort, returns the seconds or None"""
+    pathway = os.path.basename(pathFile)
+    out = os.path.join("outputFiles", pathway[0:-len("_pathway.tab")] + "_output.fa")
+    cmd = "cd %s && %s -p %s -c config.txt -b ./ -o %s > /dev/null 2>&1" \
+        % (cohort, paradigmExec, os.path.abspath(pathFile), out)
+    start = time.time()
+    status = os.system(cmd)
+    seconds = time.time() - start
+    if status != 0:
+        log("%s failed on %s with exit status %i\n" % (pathway, cohort, status))
+        return None
+    return seconds
+
+def timePathway(job):
+    """
+    runs paradigm on one pathway with one sample and with the cohort,
+    returns (pathway, seconds of inference on the cohort or None)
+    """
+    (paradigmExec, single, cohort, samples, pathFile) = job
+    pathway = os.path.basename(pathFile)
+    fixed = runPathway(paradigmExec, single, pathFile)
+    if fixed is None:
+        return (pathway, None)
+    total = runPathway(paradigmExec, cohort, pathFile)
+    if total is None:
+        return (pathway, None)
+    ## the one-sample run is the start-up plus one sample of inference;
+    ## timing noise can make the difference vanish on tiny pathways
+    perSample = max(total - fixed, 0.0) / (samples - 1)
+    log("%s: %.2fs on 1 sample, %.2fs on %i, %.4fs per sample\n"
+        % (pathway, fixed, total, samples, perSample))
+    return (pathway, perSample * samples)
+
+def timePathways(pathwayDir, paradigmExec, samples, processes, outDir, keep):
+    pathFiles = sorted(glob.glob(os.path.join(pathwayDir, "*_pathway.tab")))
+    if len(pathFiles) == 0:
+        print "no *_pathway.tab files in %s" % pathwayDir
+        sys.exit(1)
+    scratch = tempfile.mkdtemp(prefix = "timePathways.")
+    try:
+        genes = pathwayGenes(pathFiles)
+        log("cohort of %i samples on %i genes in %s\n" % (samples, len(genes), scratch))
+        single = os.path.join(scratch, "single")
+        cohort = os.path.join(scratch, "cohort")
+        for (directory, n) in [(single, 1), (cohort, samples)]:
+            os.makedirs(os.path.join(directory, "outputFiles"))
+            writeCohort(directory, genes, n)
+        ## the largest pathways first, so they do not finish last
+        stats = {}
+        for p in pathFiles:
+            stats[os.path.basename(p)] = costModel.pathwayStats(p)
+        pathFiles.sort(key = lambda p: -sum(stats[os.path.basename(p)]))
+        jobs = [(paradigmExec, single, cohort, samples, p) for p in pathFiles]
+        pool = multiprocessing.Pool(max(1, min(processes, len(jobs))))
+        try:
+            results = pool.map(timePathway, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if keep:
+            log("kept %s\n" % scratch)
+        else:
+            shutil.rmtree(scratch, True)
+    failed = [pathway for (pathway, seconds) in results if seconds is None]
+
+    tfile = open(os.path.join(outDir, "timings.tab"), "w")
+    tfile.write("# samples %i\n" % samples)
+    for (pathway, seconds) in sorted(results):
+        if seconds is not None:
+            tfile.write("%.4f\t%s\n" % (seconds, pathway))
+    tfile.close()
+    costModel.writePathwayStats(os.path.join(outDir, costModel.statsFile), stats)
+    if len(failed) > 0:
+        print "%i pathways failed: %s" % (len(failed), " ".join(failed))
+        sys.exit(10)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "e:n:j:o:kq")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        print "incorrect number of arguments"
+        usage(1)
+    pathwayDir = args[0]
+    paradigmExec = prepareParadigm.paradigmExec
+    samples = 20
+    processes = multiprocessing.cpu_count()
+    outDir = pathwayDir
+    keep = False
+    global verbose
+    for o, a in opts:
+        if o == "-e":
+            ## paradigm runs from the scratch directory
+            if os.sep in a:
+                a = os.path.abspath(a)
+            paradigmExec = a
+        elif o == "-n":
+            samples = int(a)
+        elif o == "-j":
+            processes = int(a)
+        elif o == "-o":
+            outDir = a
+        elif o == "-k":
+            keep = True
+        elif o == "-q":
+            verbose = False
+    if samples < 2:
+        print "-n must be at least 2"
+        usage(1)
+    timePathways(pathwayDir, paradigmExec, samples, processes, outDir, keep)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -9,6 +9,8 @@ Options:
    -p dir               the directory containing pathway files 
    -b flt;flt[,flt;flt] boundaries for discretization, use comma to specify different
                         boundaries per evidence (default 0.333;0.667)
+   -w dir               parameter cache to start EM from and add the converged
+                        parameters to (see paramCache.py)
 """
 ## Written by: Sam Ng
 import getopt, os, os.path, re, sys
@@ -32,7 +34,7 @@ paradigmExec = "%s/paradigm" % (exeDir)
 inferSpec = "method=BP,updates=SEQFIX,tol=1e-9,maxiter=10000,logdomain=0"
 
 class prepareParadigm(Target):
-    def __init__(self, evidSpec, disc, paramFile, nullBatches, paradigmExec, inferSpec, dogmaLib, pathwayLib, em, directory):
+    def __init__(self, evidSpec, disc, paramFile, nullBatches, paradigmExec, inferSpec, dogmaLib, pathwayLib, em, directory, paramCacheDir=None):
         Target.__init__(self, time=10000)
         self.evidSpec = evidSpec
         self.disc = disc
@@ -44,12 +46,17 @@ class prepareParadigm(Target):
         self.pathwayLib = pathwayLib
         self.em = em
         self.directory = directory
+        self.paramCacheDir = paramCacheDir
     def run(self):
         os.chdir(self.directory)
+        if self.paramCacheDir is not None:
+            cacheOption = "-w %s " % (self.paramCacheDir)
+        else:
+            cacheOption = ""
         if self.paramFile is not None:
-            cmd = "prepareParadigm.py -b \"%s\" -t %s -s same -n %s -i %s -e %s -d %s -p %s %s >& jt.err" % (self.disc, self.paramFile, self.nullBatches, self.inferSpec, self.paradigmExec, self.dogmaLib, self.pathwayLib, self.evidSpec)
+            cmd = "prepareParadigm.py -b \"%s\" -t %s %s-s same -n %s -i %s -e %s -d %s -p %s %s >& jt.err" % (self.disc, self.paramFile, cacheOption, self.nullBatches, self.inferSpec, self.paradigmExec, self.dogmaLib, self.pathwayLib, self.evidSpec)
         else:
-            cmd = "prepareParadigm.py -b \"%s\" -s same -n %s -i %s -e %s -d %s -p %s %s >& jt.err" % (self.disc, self.nullBatches, self.inferSpec, self.paradigmExec, self.dogmaLib, self.pathwayLib, self.evidSpec)
+            cmd = "prepareParadigm.py -b \"%s\" %s-s same -n %s -i %s -e %s -d %s -p %s %s >& jt.err" % (self.disc, cacheOption, self.nullBatches, self.inferSpec, self.paradigmExec, self.dogmaLib, self.pathwayLib, self.evidSpec)
         system(cmd)
         self.setFollowOnTarget(jtParadigm(self.em, self.directory))
 
@@ -77,6 +84,7 @@ def wrapParadigm():
     parser.add_option("-n", "--nulls", dest="nullBatches", help="Number of Null Samples", default="5")
     parser.add_option("-t", "--storedparam", dest="paramFile", help="Initial Parameter Starting Point", default="")
     parser.add_option("-s", "--skipem", action="store_false", dest="runEM", help="Skip Running EM", default=True)
+    parser.add_option("-w", "--paramcache", dest="paramCache", help="Parameter Cache to Warm-Start EM from", default="")
     options, args = parser.parse_args()
     print "Using Batch System '" + options.batchSystem + "'"
    
@@ -109,11 +117,15 @@ def wrapParadigm():
     else:
         paramFile = options.paramFile
     runEM = options.runEM
+    if len(options.paramCache) == 0:
+        paramCacheDir = None
+    else:
+        paramCacheDir = os.path.abspath(options.paramCache)
     logger.info("options: " + str(options))
     
     ## run
     logger.info("starting prepare")
-    s = Stack(prepareParadigm(" ".join(evidList), disc, paramFile, nullBatches, paradigmExec, inferSpec, dogma, pathway, runEM, os.getcwd()))
+    s = Stack(prepareParadigm(" ".join(evidList), disc, paramFile, nullBatches, paradigmExec, inferSpec, dogma, pathway, runEM, os.getcwd(), paramCacheDir))
     if options.jobFile:
         s.addToJobFile(options.jobFile)
     else:
@@ -3,6 +3,10 @@
 import sys
 import array
 from math import isnan, sqrt
+try:
+    import matrixCache
+except ImportError:
+    matrixCache = None
 
 
 def median(inList):
@@ -28,6 +32,11 @@ class FloatMatrix:
         self.colmap = None
 
     def read(self, handle):
+        if matrixCache is not None and hasattr(handle, "name"):
+            cached = matrixCache.loadCache(handle.name)
+            if cached is not None:
+                self.read_cache(cached)
+                return
         header = None
         for line in handle:
             row = line.rstrip().split("\t")
@@ -53,6 +62,17 @@ class FloatMatrix:
                 self.data.extend(a)
                 self.nrows += 1
 
+    def read_cache(self, cached):
+        self.colmap = {}
+        for i, c in enumerate(cached.cols):
+            self.colmap[c] = i
+        self.rowmap = {}
+        for r in cached.rows:
+            self.rowmap[r] = len(self.rowmap)
+        self.ncols = cached.numCols
+        self.nrows = cached.numRows
+        self.data = cached.getValues()
+
     def init_blank(self, rows, cols):
         self.data = array.array("f")
         self.colmap = {}
@@ -97,23 +97,17 @@ def wCRSData(outf, outData, delim = "\t", useCols = None, useRows = None):
         rowFeatures = outData[colFeatures[0]].keys()
     else:
         rowFeatures = useRows
-    ## write header
+    ## each line is written whole, values as "%s" writes them (nan as nan)
     f = open(outf, "w")
-    f.write("id")
-    for i in colFeatures:
-        f.write("\t%s" % (i))
-    f.write("\n")
+    f.write("\t".join(["id"] + list(colFeatures)) + "\n")
     for i in rowFeatures:
-        f.write("%s" % (i))
+        fields = [i]
         for j in colFeatures:
-            if j in outData:
-                if i in outData[j]:
-                    f.write("\t%s" % (outData[j][i]))
-                else:
-                    f.write("\tNA") 
+            if j in outData and i in outData[j]:
+                fields.append("%s" % (outData[j][i]))
             else:
-                f.write("\tNA")
-        f.write("\n")
+                fields.append("NA")
+        f.write("\t".join(fields) + "\n")
     f.close()
 
 def floatList(inList):